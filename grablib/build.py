@@ -1,19 +1,30 @@
+import filecmp
 import hashlib
 import json
+import os
 import re
 import shutil
 import tempfile
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
 from datetime import datetime
 from pathlib import Path
-from typing import Callable, Union
+from typing import Callable, Optional, Tuple, Union
+from uuid import uuid4
 
 import click
 
+from .cache import FileCache, cache_root
 from .common import GrablibError, main_logger, progress_logger
+from .compress import compress_file, compress_formats
+from .replace import Replacer
+from .sourcemap import SourceMap
 
 STARTS_DOWNLOAD = re.compile('^(?:DOWNLOAD|DL)/')
 STARTS_NODE_M = re.compile('^(?:NODE_MODULES|NM)/')
 STARTS_SRC = re.compile('^SRC/')
+SASS_EXTENSIONS = '.scss', '.sass', '.css'
+WRITE_BUFFER_SIZE = 256 * 1024
 StrPath = Union[str, Path]
 
 
@@ -25,7 +36,14 @@ def insert_hash(path: Path, content: Union[str, bytes], *, hash_length=7, hash_a
     """
     if isinstance(content, str):
         content = content.encode()
-    hash_ = hash_algorithm(content).hexdigest()[:hash_length]
+    return path_with_hash(path, hash_algorithm(content).hexdigest(), hash_length=hash_length)
+
+
+def path_with_hash(path: Path, digest: str, *, hash_length=7):
+    """
+    Insert digest, truncated to hash_length, into the path after the first dot.
+    """
+    hash_ = digest[:hash_length]
     if '.' in path.name:
         new_name = re.sub(r'\.', f'.{hash_}.', path.name, count=1)
     else:
@@ -33,18 +51,137 @@ def insert_hash(path: Path, content: Union[str, bytes], *, hash_length=7, hash_a
     return path.with_name(new_name)
 
 
+class OutputFile:
+    """
+    Wraps a binary file so text can be written to it, optionally hashing the data as it's written.
+    """
+
+    def __init__(self, f, path: Path, hash_: bool):
+        self._f = f
+        self._hash = hash_ and hashlib.md5()
+        # final path of the file, set once it's complete and includes the hash if used
+        self.path = path
+
+    def write(self, text: str):
+        data = text.encode()
+        self._hash and self._hash.update(data)
+        self._f.write(data)
+
+    def hexdigest(self) -> Optional[str]:
+        return self._hash and self._hash.hexdigest()
+
+
+def write_if_changed(path: Path, content: Union[str, bytes]) -> bool:
+    """
+    Write content to path unless the file already contains it, so unchanged files keep their modification time.
+    Content is written to a temporary file then renamed so path is never partially written.
+
+    :return: whether the file was written
+    """
+    data = content.encode() if isinstance(content, str) else content
+    try:
+        if path.stat().st_size == len(data) and path.read_bytes() == data:
+            return False
+    except FileNotFoundError:
+        pass
+    tmp_path = path.with_name('.{}.{}.tmp'.format(path.name, uuid4().hex))
+    try:
+        tmp_path.write_bytes(data)
+        tmp_path.replace(path)
+    finally:
+        tmp_path.exists() and tmp_path.unlink()
+    return True
+
+
+def file_signature(path: StrPath) -> list:
+    """
+    Get [mtime_ns, size, content hash] for a file, the file is stated before it's read so a change during the read is
+    seen by the next check.
+    """
+    stat = os.stat(str(path))
+    with open(str(path), 'rb') as f:
+        return [stat.st_mtime_ns, stat.st_size, hashlib.md5(f.read()).hexdigest()]
+
+
+class ImportCache:
+    """
+    Contents of files imported by sass, shared by every compile in a process. Files are checked against their size
+    and modification time so changes are seen when watching or building incrementally.
+    """
+
+    def __init__(self):
+        self._files = {}
+
+    def read(self, path: Path) -> Tuple[str, list]:
+        """
+        :return: tuple of (file content, signature of the content as returned by file_signature)
+        """
+        stat = path.stat()
+        key = stat.st_mtime_ns, stat.st_size
+        cached = self._files.get(path)
+        if cached and cached[0] == key:
+            return cached[1:]
+        data = path.read_bytes()
+        self._files[path] = key, data.decode(), [*key, hashlib.md5(data).hexdigest()]
+        return self._files[path][1:]
+
+
+import_cache = ImportCache()
+
+
+def resolve_sass_import(path: Path) -> Optional[Path]:
+    """
+    Find the file sass would import for path, eg. "foo/bar" might be "foo/_bar.scss" or "foo/bar/_index.scss".
+    """
+    if path.suffix in SASS_EXTENSIONS:
+        candidates = [path, path.with_name('_' + path.name)]
+    else:
+        candidates = [
+            d / (prefix + name + ext)
+            for d, name in ((path.parent, path.name), (path, 'index'))
+            for ext in SASS_EXTENSIONS
+            for prefix in ('', '_')
+        ]
+    return next((c for c in candidates if c.is_file()), None)
+
+
 class Builder:
     """
     main class for "building" assets eg. concatenating and minifying js and compiling sass
     """
 
-    def __init__(self, *, build_root: StrPath, build: dict, download_root: StrPath = None, debug=False, **data):
+    def __init__(
+        self,
+        *,
+        build_root: StrPath,
+        build: dict,
+        download_root: StrPath = None,
+        debug=False,
+        cache: Union[bool, StrPath] = None,
+        cache_max_size: int = 1024,
+        **data,
+    ):
+        """
+        :param cache: True to cache minified files in the standard user cache directory, or the directory to use,
+          manifests for incremental sass builds are kept here or in the standard directory if it's not set
+        :param cache_max_size: maximum size of the cache in MB, least recently used files are removed beyond this
+        """
         self.build_root = Path(build_root).absolute()
         self.build = build
         self.download_root = download_root and Path(download_root).resolve()
         self.files_built = 0
+        self.outputs_unchanged = 0
         self.debug = debug
+        self.workers = build.get('workers', 1)
+        self.source_maps = build.get('source_maps', False)
+        self.apply_hash = build.get('apply_hash', False)
+        self.compress = compress_formats(build.get('compress', False))
         self._jsmin = None
+        self._jsmin_version = None
+        # replace rules compiled once per build
+        self._replacers = {}
+        self._cache = cache and FileCache(cache_root(cache) / 'jsmin', cache_max_size * MB)
+        self._sass_manifest_dir = cache_root(cache or True) / 'sass'
 
     def __call__(self):
         wipe_data = self.build.get('wipe', None)
@@ -59,33 +196,78 @@ class Builder:
     def cat(self, data):
         start = datetime.now()
         total_files_combined = 0
+        self.outputs_unchanged = 0
+        bundles = []
         for dest, srcs in data.items():
             if not isinstance(srcs, list):
                 raise GrablibError('source files for concatenation should be a list')
-
-            final_content, files_combined = '', 0
-            for src in srcs:
-                if isinstance(src, str):
-                    src = {'src': src}
-                path = self._file_path(src['src'])
-                content = self._read_file(path)
-                files_combined += 1
-                for pattern, rep in src.get('replace', {}).items():
-                    content = re.sub(pattern, rep, content)
-                final_content += '/* === {} === */\n{}\n'.format(path.name, content.strip('\n'))
-                progress_logger.debug('  appending %s', path.name)
-
-            if files_combined == 0:
+            if not srcs:
                 main_logger.warning('no files found to form "%s"', dest)
                 continue
-            dest_path = self._dest_path(dest)
-            self._write(dest_path, final_content)
-            total_files_combined += files_combined
-            progress_logger.info('%d files combined to form "%s"', files_combined, dest)
-
+            srcs = [{'src': src} if isinstance(src, str) else src for src in srcs]
+            bundles.append((dest, [(self._file_path(src['src']), src.get('replace', {})) for src in srcs]))
+
+        hashed_files, outputs = {}, []
+        with ExitStack() as stack:
+            pending = {}
+            if self.workers > 1:
+                # sources which need minifying are minified at once, results are used in the order declared,
+                # everything else is read as it's written
+                executor = stack.enter_context(ProcessPoolExecutor(max_workers=self.workers))
+                for dest, srcs in bundles:
+                    for i, (path, replace) in enumerate(srcs):
+                        future = self._minifies(path) and self._submit_minify(path, replace, executor)
+                        if future:
+                            pending[(dest, i)] = future
+
+            for dest, srcs in bundles:
+                path = self._write_bundle(dest, srcs, pending)
+                outputs.append(path)
+                self.apply_hash and hashed_files.update({self._dest_path(dest): path})
+                total_files_combined += len(srcs)
+                progress_logger.info('%d files combined to form "%s"', len(srcs), dest)
+
+        self._cache and self._cache.evict()
+        self._update_manifest(hashed_files)
+        self._compress_outputs(outputs)
         time_taken = (datetime.now() - start).total_seconds() * 1000
+        if self.outputs_unchanged:
+            main_logger.info('%d concatenated files unchanged and not rewritten', self.outputs_unchanged)
         main_logger.info('%d files concatenated in %0.0fms', total_files_combined, time_taken)
 
+    def _write_bundle(self, dest: str, srcs: list, pending: dict) -> Path:
+        """
+        Write sources to dest, sources not being minified in pending are read as they're written so only one is
+        in memory at a time. If source_maps is set the map is built as each source is written.
+
+        :return: path of the file written, this includes the content hash if apply_hash is set
+        """
+        dest_path = self._dest_path(dest)
+        # the map name can't include the bundle's hash since the bundle references the map
+        map_path = dest_path.with_name(dest_path.name + '.map')
+        source_map = self.source_maps and SourceMap(dest_path.name)
+        with self._open_atomic(dest_path, apply_hash=self.apply_hash) as f:
+            for i, (path, replace) in enumerate(srcs):
+                future = pending.pop((dest, i), None)
+                content = future.result() if future else self._read_source(path, replace)
+                stripped = content.strip('\n')
+                f.write('/* === {} === */\n'.format(path.name))
+                f.write(stripped)
+                f.write('\n')
+                progress_logger.debug('  appending %s', path.name)
+                if source_map:
+                    source_map.skip_lines(1)
+                    source = source_map.add_source(Path(os.path.relpath(str(path), str(map_path.parent))).as_posix())
+                    first_line = len(content) - len(content.lstrip('\n'))
+                    minified = self._minifies(path)
+                    source_map.add_lines(source, stripped.count('\n') + 1, first_line, minified=minified)
+
+            if source_map:
+                comment = '/*# sourceMappingURL={} */' if dest.endswith('.css') else '//# sourceMappingURL={}'
+                f.write(comment.format(map_path.name) + '\n')
+        source_map and write_if_changed(map_path, source_map.dumps())
+        return f.path
+
     def sass(self, data):
         for dest, d in data.items():
             if isinstance(d, str):
@@ -100,28 +282,74 @@ class Builder:
                 exclude=d.get('exclude'),
                 replace=d.get('replace'),
                 debug=self.debug,
+                workers=d.get('workers', self.workers),
+                incremental=d.get('incremental', False),
+                manifest_dir=self._sass_manifest_dir,
+                apply_hash=d.get('apply_hash', self.apply_hash),
             )
             sass_gen()
+            self._update_manifest(sass_gen.hashed_files)
+            self._compress_outputs(sass_gen.outputs)
 
     def wipe(self, regexes):
         if isinstance(regexes, str):
             regexes = [regexes]
-        count = 0
         regexes = [re.compile(r) for r in regexes]
-        for path in self.build_root.glob('**/*'):
-            relative_path = str(path.relative_to(self.build_root))
-            for regex in regexes:
-                if regex.fullmatch(relative_path):
-                    if path.is_dir():
-                        progress_logger.debug('deleting directory "%s" based on "%s"', relative_path, regex.pattern)
-                        shutil.rmtree(str(path))
-                    else:
-                        assert path.is_file()
-                        progress_logger.debug('deleting file "%s" on "%s"', relative_path, regex.pattern)
-                        path.unlink()
-                    count += 1
-                    break
-        main_logger.info('%d paths deleted', count)
+        matches = list(self._find_wipe_matches(regexes))
+        if self.workers > 1 and len(matches) > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                list(executor.map(self._wipe_path, matches))
+        else:
+            for match in matches:
+                self._wipe_path(match)
+        main_logger.info('%d paths deleted', len(matches))
+
+    def _find_wipe_matches(self, regexes):
+        """
+        Walk build_root yielding (path, relative path, is directory, regex) for paths matching a regex, directories
+        which match aren't searched since they'll be deleted along with their contents.
+        """
+        combined = self._combine_regexes(regexes)
+        dirs = [(str(self.build_root), '')]
+        while dirs:
+            dir_path, rel_dir = dirs.pop()
+            try:
+                entries = sorted(os.scandir(dir_path), key=lambda e: e.name)
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                relative_path = os.path.join(rel_dir, entry.name)
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if not combined or combined.fullmatch(relative_path):
+                    regex = next((r for r in regexes if r.fullmatch(relative_path)), None)
+                    if regex:
+                        yield entry.path, relative_path, is_dir, regex
+                        continue
+                if is_dir:
+                    dirs.append((entry.path, relative_path))
+
+    @staticmethod
+    def _combine_regexes(regexes):
+        """
+        One regex to test every path at once, or None if regexes can't be combined: numbered groups would change
+        and inline flags like "(?i)" are only valid at the start of a pattern.
+        """
+        if any(r.groups or r.flags & ~re.UNICODE for r in regexes):
+            return
+        try:
+            return re.compile('|'.join('(?:{})'.format(r.pattern) for r in regexes))
+        except re.error:
+            return
+
+    @staticmethod
+    def _wipe_path(match):
+        path, relative_path, is_dir, regex = match
+        if is_dir:
+            progress_logger.debug('deleting directory "%s" based on "%s"', relative_path, regex.pattern)
+            shutil.rmtree(path)
+        else:
+            progress_logger.debug('deleting file "%s" on "%s"', relative_path, regex.pattern)
+            os.unlink(path)
 
     def _dest_path(self, p):
         new_path = self.build_root.joinpath(p)
@@ -140,25 +368,120 @@ class Builder:
     def jsmin(self) -> Callable[[str, str], str]:
         if self._jsmin is None:
             try:
-                from jsmin import jsmin
+                import jsmin
             except ImportError as e:
                 main_logger.error('ImportError importing jsmin: %s', e)
                 raise GrablibError(
                     'Error importing jsmin. Build requirements probably not installed, run `pip install grablib[build]`'
                 ) from e
             else:
-                self._jsmin = jsmin
+                self._jsmin = jsmin.jsmin
+                self._jsmin_version = getattr(jsmin, '__version__', '')
         return self._jsmin
 
-    def _read_file(self, file_path: Path):
+    def _read_source(self, file_path: Path, replace: dict) -> str:
+        """
+        Read, minify and apply replace to a source file, the result is cached if minification is required.
+        """
         content = file_path.read_text()
-        if not self.debug and file_path.name.endswith('.js') and not file_path.name.endswith('.min.js'):
-            return self.jsmin(content, quote_chars='\'"`')
+        if not self._minifies(file_path):
+            return self._replace(content, replace)
+
+        key = self._cache_key(content, replace)
+        cache_path = key and self._cache.get(key)
+        if cache_path:
+            progress_logger.debug('  using cached minified %s', file_path.name)
+            return cache_path.read_bytes().decode()
+
+        content = self._minify(content, replace)
+        key and self._cache.put_bytes(key, content.encode())
         return content
 
-    def _write(self, new_path: Path, data):
+    def _submit_minify(self, file_path: Path, replace: dict, executor: ProcessPoolExecutor) -> Optional[Future]:
+        """
+        Minify a source file in a worker process unless the result is cached, cached results are left to be read
+        by _read_source when the source is written.
+        """
+        content = file_path.read_text()
+        key = self._cache_key(content, replace)
+        if key and self._cache.get(key):
+            return
+        future = executor.submit(self._minify, content, replace)
+        key and future.add_done_callback(lambda f: f.exception() or self._cache.put_bytes(key, f.result().encode()))
+        return future
+
+    def _cache_key(self, content: str, replace: dict) -> Optional[str]:
+        if self._cache:
+            # self.jsmin imports jsmin so its version is known
+            jsmin_version = self.jsmin and self._jsmin_version
+            key_data = hashlib.md5(content.encode()).hexdigest(), jsmin_version, list(replace.items())
+            return hashlib.md5(json.dumps(key_data).encode()).hexdigest()
+
+    def _minify(self, content: str, replace: dict) -> str:
+        return self._replace(self.jsmin(content, quote_chars='\'"`'), replace)
+
+    def _minifies(self, file_path: Path) -> bool:
+        return not self.debug and file_path.name.endswith('.js') and not file_path.name.endswith('.min.js')
+
+    def _replace(self, content: str, replace: dict):
+        if not replace:
+            return content
+        key = tuple(replace.items())
+        replacer = self._replacers.get(key)
+        if replacer is None:
+            replacer = self._replacers[key] = Replacer(replace)
+        return replacer(content)[0]
+
+    def _compress_outputs(self, paths: list):
+        """
+        Write compressed copies of outputs if compress is set, only outputs which have changed since they were last
+        compressed are compressed.
+        """
+        if not self.compress or not paths:
+            return
+        # zlib and brotli release the GIL so threads are enough to compress in parallel
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            written = sum(executor.map(compress_file, paths, [self.compress] * len(paths)))
+        progress_logger.info('%d compressed files written for %d outputs', written, len(paths))
+
+    def _update_manifest(self, hashed_files: dict):
+        """
+        Add hashed file names to manifest.json in build_root, it maps the name of each file without a hash to the
+        name with a hash.
+        """
+        if not hashed_files:
+            return
+        manifest_path = self.build_root / 'manifest.json'
+        manifest = json.loads(manifest_path.read_text()) if manifest_path.exists() else {}
+        for path, hashed_path in hashed_files.items():
+            manifest[path.relative_to(self.build_root).as_posix()] = hashed_path.relative_to(self.build_root).as_posix()
+        write_if_changed(manifest_path, json.dumps(manifest, indent=2, sort_keys=True) + '\n')
+
+    @contextmanager
+    def _open_atomic(self, new_path: Path, *, apply_hash: bool = False):
+        """
+        Open a temporary file for writing which replaces new_path once it's complete, so new_path is never left
+        partially written. If new_path already has the same content it's left untouched.
+
+        With apply_hash the content is hashed as it's written and the hash inserted into the file name,
+        the final path is available as the "path" attribute of the file once the context has exited.
+        """
         new_path.parent.mkdir(parents=True, exist_ok=True)
-        new_path.write_text(data)
+        tmp_path = new_path.with_name('.{}.{}.tmp'.format(new_path.name, uuid4().hex))
+        try:
+            with tmp_path.open('wb', buffering=WRITE_BUFFER_SIZE) as f:
+                output = OutputFile(f, new_path, apply_hash)
+                yield output
+            if apply_hash:
+                new_path = output.path = path_with_hash(new_path, output.hexdigest())
+            # filecmp compares sizes before reading either file
+            if new_path.exists() and filecmp.cmp(str(tmp_path), str(new_path), shallow=False):
+                progress_logger.debug('"%s" unchanged', new_path.name)
+                self.outputs_unchanged += 1
+            else:
+                tmp_path.replace(new_path)
+        finally:
+            tmp_path.exists() and tmp_path.unlink()
 
 
 class SassGenerator:
@@ -177,14 +500,33 @@ class SassGenerator:
         custom_functions: Union[dict, set, list] = (),
         extra_importers: list = (),
         apply_hash: bool = False,
+        workers: int = 1,
+        incremental: bool = False,
+        manifest_dir: Path = None,
     ):
+        """
+        :param workers: number of processes to compile files with, custom_functions and extra_importers must be
+          picklable to use more than one
+        :param incremental: only compile files where the file or anything it imports has changed since the last
+          build, not used in debug mode
+        :param manifest_dir: directory for the manifest of files imported used by incremental builds, defaults to
+          the standard user cache directory
+        """
         self._in_dir = input_dir
         dir_hash = hashlib.md5(str(self._in_dir).encode()).hexdigest()
         self._size_cache_file = Path(tempfile.gettempdir()) / 'grablib_cache.{}.json'.format(dir_hash)
-        assert self._in_dir.is_dir()
+        dirs_hash = hashlib.md5('{}:{}'.format(input_dir, output_dir).encode()).hexdigest()
+        manifest_dir = manifest_dir or cache_root(True) / 'sass'
+        self._manifest_file = manifest_dir / 'manifest.{}.json'.format(dirs_hash)
+        if not self._in_dir.is_dir():
+            raise GrablibError('sass source directory "{}" does not exist'.format(self._in_dir))
         self._out_dir = output_dir
         self._debug = debug
         self._apply_hash = apply_hash
+        # css paths without hashes to the paths generated when apply_hash is set
+        self.hashed_files = {}
+        # all css files generated or left unchanged
+        self.outputs = []
         self._custom_functions = custom_functions
         self._importers = list(extra_importers) + [(5, self._clever_imports)]
         if self._debug:
@@ -195,14 +537,30 @@ class SassGenerator:
         self._include = re.compile(include or r'/[^_][^/]+\.(?:css|sass|scss)$')
         self._exclude = exclude and re.compile(exclude)
         self._replace = replace or {}
+        self._replacers = [(re.compile(path_regex), Replacer(rules)) for path_regex, rules in self._replace.items()]
         self.download_root = download_root
         self._nm = self._find_node_modules()
         self._old_size_cache = {}
         self._new_size_cache = {}
+        self._workers = workers
+        self._incremental = incremental and not debug
+        self._old_manifest = {}
+        self._new_manifest = {}
+        self._signatures = {}
+        self._deps = None
+        self._resolved = {}
+
+    def __getstate__(self):
+        # the generator is pickled to compile files in worker processes, caches and manifests aren't required there
+        state = self.__dict__.copy()
+        state.update(_old_size_cache={}, _new_size_cache={}, _old_manifest={}, _new_manifest={}, _signatures={})
+        return state
 
     def __call__(self):
         start = datetime.now()
-        self._errors, self._files_generated = 0, 0
+        self._errors, self._files_generated, self._files_unchanged, self._outputs_unchanged = 0, 0, 0, 0
+        # files may have been created since the last build
+        self._resolved = {}
 
         if self._debug:
             self._out_dir.mkdir(parents=True, exist_ok=True)
@@ -217,10 +575,19 @@ class SassGenerator:
             with self._size_cache_file.open() as f:
                 self._old_size_cache = json.load(f)
 
+        if self._incremental:
+            self._old_manifest = self._read_manifest()
+
         self.process_directory(self._src_dir)
         with self._size_cache_file.open('w') as f:
             json.dump(self._new_size_cache, f, indent=2)
+        if self._incremental:
+            self._save_manifest()
         time_taken = (datetime.now() - start).total_seconds() * 1000
+        if self._files_unchanged:
+            main_logger.info('%d css files unchanged and not recompiled', self._files_unchanged)
+        if self._outputs_unchanged:
+            main_logger.info('%d css files unchanged and not rewritten', self._outputs_unchanged)
         if not self._errors:
             main_logger.info('%d css files generated in %0.0fms, 0 errors', self._files_generated, time_taken)
         else:
@@ -229,30 +596,145 @@ class SassGenerator:
             )
             raise GrablibError('sass errors')
 
-    def process_directory(self, d: Path):
-        assert d.is_dir()
-        for p in d.iterdir():
-            if p.is_dir():
-                self.process_directory(p)
-            else:
-                assert p.is_file()
-                self.process_file(p)
+    def _read_manifest(self) -> dict:
+        """
+        Read the files compiled by the last build with the same settings, an unreadable or invalid manifest
+        means everything is compiled.
+        """
+        try:
+            manifest = json.loads(self._manifest_file.read_text())
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            progress_logger.warning('unable to read sass manifest "%s": %s', self._manifest_file, e)
+            return {}
+        if not isinstance(manifest, dict) or manifest.get('settings') != self._settings_hash():
+            return {}
+        files = manifest.get('files')
+        if not isinstance(files, dict) or not all(map(self._valid_manifest_entry, files.values())):
+            progress_logger.warning('invalid sass manifest "%s", ignoring it', self._manifest_file)
+            return {}
+        return files
+
+    @staticmethod
+    def _valid_manifest_entry(entry) -> bool:
+        return (
+            isinstance(entry, dict)
+            and isinstance(entry.get('outputs'), list)
+            and len(entry['outputs']) > 0
+            and all(isinstance(p, str) for p in entry['outputs'])
+            and isinstance(entry.get('deps'), dict)
+            and all(isinstance(s, list) and len(s) == 3 for s in entry['deps'].values())
+        )
+
+    def _save_manifest(self):
+        manifest = json.dumps({'settings': self._settings_hash(), 'files': self._new_manifest}, indent=2)
+        try:
+            self._manifest_file.parent.mkdir(parents=True, exist_ok=True)
+            write_if_changed(self._manifest_file, manifest)
+        except OSError as e:
+            # without the manifest the next build compiles everything, that shouldn't stop this build
+            progress_logger.warning('unable to write sass manifest "%s": %s', self._manifest_file, e)
 
-    def process_file(self, f: Path):
-        if not self._include.search(str(f)):
-            return
-        if self._exclude and self._exclude.search(str(f)):
-            return
+    def process_directory(self, d: Path):
+        files = [f for f in self._find_files(d) if not (self._incremental and self._unchanged(f))]
+        if self._workers > 1 and len(files) > 1:
+            map_paths = [self._paths(f)[2] for f in files]
+            chunksize = max(1, len(files) // (self._workers * 4))
+            with ProcessPoolExecutor(max_workers=self._workers) as executor:
+                # results are returned in the order files were found, so output and logging are deterministic
+                results = executor.map(self.generate_css, files, map_paths, chunksize=chunksize)
+                for f, compiled in zip(files, results):
+                    self.process_file(f, compiled)
+        else:
+            for f in files:
+                self.process_file(f)
 
+    def _find_files(self, d: Path):
+        assert d.is_dir()
+        yield from map(Path, self._scan_dir(str(d)))
+
+    def _scan_dir(self, d: str):
+        """
+        Yield paths of files in d to compile, file types come from the directory entries so only candidate files
+        are tested against include and exclude. Directories whose path followed by a separator matches exclude aren't
+        searched.
+        """
+        for entry in sorted(os.scandir(d), key=lambda e: e.name):
+            if entry.is_dir():
+                if not (self._exclude and self._exclude.search(entry.path + os.sep)):
+                    yield from self._scan_dir(entry.path)
+            elif entry.is_file():
+                if self._include.search(entry.path) and not (self._exclude and self._exclude.search(entry.path)):
+                    yield entry.path
+
+    def _paths(self, f: Path):
         rel_path = f.relative_to(self._src_dir)
         css_path = (self._out_dir / rel_path).with_suffix('.css')
-
         map_path = css_path.with_name(css_path.name + '.map') if self._debug else None
-
-        css = self.generate_css(f, map_path)
-        if css is None:
+        return rel_path, css_path, map_path
+
+    def _unchanged(self, f: Path) -> bool:
+        """
+        Check if f and all the files it imported when it was last compiled are unchanged and its output exists.
+        """
+        rel_path = str(self._paths(f)[0])
+        entry = self._old_manifest.get(rel_path)
+        if not entry or not all(os.path.exists(p) for p in entry['outputs']):
+            return False
+        deps = {}
+        for path, signature in entry['deps'].items():
+            deps[path] = self._file_signature(path, signature)
+            if deps[path] is None or deps[path][2] != signature[2]:
+                return False
+
+        progress_logger.debug('%s and its imports are unchanged, not compiling', rel_path)
+        self._new_manifest[rel_path] = dict(entry, deps=deps)
+        self.outputs.append(Path(entry['outputs'][0]))
+        if self._apply_hash:
+            self.hashed_files[self._paths(f)[1]] = Path(entry['outputs'][0])
+        for p in entry['outputs']:
+            if p in self._old_size_cache:
+                self._new_size_cache[p] = self._old_size_cache[p]
+        self._files_unchanged += 1
+        return True
+
+    def _file_signature(self, path: str, previous: list = None) -> Optional[list]:
+        """
+        Get [mtime_ns, size, content hash] for a file, the file is only read if its stat differs from previous.
+        """
+        if path not in self._signatures:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                signature = None
+            else:
+                if previous and previous[:2] == [stat.st_mtime_ns, stat.st_size]:
+                    signature = previous
+                else:
+                    signature = file_signature(path)
+            self._signatures[path] = signature
+        return self._signatures[path]
+
+    def _settings_hash(self):
+        """
+        Hash of the settings which affect output, if they change every file needs compiling.
+        """
+        settings = self._debug, self._apply_hash, self._replace, str(self._out_dir)
+        return hashlib.md5(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+    def process_file(self, f: Path, compiled: tuple = None):
+        """
+        Compile f, or use the result of compiling it in a worker process, and write the css.
+        """
+        rel_path, css_path, map_path = self._paths(f)
+        unhashed_css_path = css_path
+        css, error, deps = compiled or self.generate_css(f, map_path)
+        if error:
+            self._errors += 1
+            main_logger.error('"%s", compile error: %s', f, error)
             return
-        log_msg = None
+        log_msgs = []
         apply_hash = self._apply_hash
         try:
             css_path.parent.mkdir(parents=True, exist_ok=True)
@@ -266,23 +748,40 @@ class SassGenerator:
 
                 # correct the link to map file in css
                 css = re.sub(r'/\*# sourceMappingURL=\S+ \*/', '/*# sourceMappingURL={} */'.format(map_path.name), css)
-                map_path.write_text(css_map)
-            css, log_msg = self._regex_modify(rel_path, css)
+                write_if_changed(map_path, css_map)
+            css, log_msgs = self._regex_modify(rel_path, css)
         finally:
             self._log_file_creation(rel_path, css_path, css)
-            if log_msg:
+            for log_msg in log_msgs:
                 progress_logger.debug(log_msg)
 
         if apply_hash:
             css_path = insert_hash(css_path, css)
-        css_path.write_text(css)
+        if not write_if_changed(css_path, css):
+            self._outputs_unchanged += 1
         self._files_generated += 1
+        self.outputs.append(css_path)
+        if self._apply_hash:
+            self.hashed_files[unhashed_css_path] = css_path
+        if self._incremental and deps is not None:
+            self._new_manifest[str(rel_path)] = {
+                'outputs': [str(p) for p in (css_path, map_path) if p],
+                'deps': deps,
+            }
 
     def generate_css(self, f: Path, map_path):
+        """
+        Compile f, this may be called in a worker process so errors are returned rather than logged.
+
+        :return: tuple of (css or (css, css_map) in debug mode, error message, signatures of f and the files it
+          imported from when they were read or None if the imports couldn't all be found or it's not incremental)
+        """
         output_style = 'nested' if self._debug else 'compressed'
         sass = self.get_sass()
         try:
-            return sass.compile(
+            # signatures are taken as files are read so a file saved during the compile is seen by the next build
+            self._deps = self._incremental and {str(f): file_signature(f)} or None
+            css = sass.compile(
                 filename=str(f),
                 source_map_filename=map_path and str(map_path),
                 output_style=output_style,
@@ -290,23 +789,23 @@ class SassGenerator:
                 importers=self._importers,
                 custom_functions=self._custom_functions,
             )
-        except sass.CompileError as e:
-            self._errors += 1
-            main_logger.error('"%s", compile error: %s', f, e)
+        except (sass.CompileError, OSError) as e:
+            return None, str(e), None
+        else:
+            return css, None, self._deps and {os.path.abspath(p): s for p, s in sorted(self._deps.items())}
 
     def _regex_modify(self, rel_path, css):
-        log_msg = None
-        for path_regex, regex_map in self._replace.items():
-            if re.search(path_regex, str(rel_path)):
-                progress_logger.debug('%s has regex replace matches for "%s"', rel_path, path_regex)
-                for pattern, repl in regex_map.items():
-                    hash1 = hash(css)
-                    css = re.sub(pattern, repl, css)
-                    if hash(css) == hash1:
-                        log_msg = '  "{}" ➤ "{}" didn\'t modify the source'.format(pattern, repl)
+        log_msgs = []
+        for path_regex, replacer in self._replacers:
+            if path_regex.search(str(rel_path)):
+                progress_logger.debug('%s has regex replace matches for "%s"', rel_path, path_regex.pattern)
+                css, counts = replacer(css)
+                for (pattern, repl), count in zip(replacer.rules, counts):
+                    if count:
+                        log_msgs.append('  "{}" ➤ "{}" made {} replacements'.format(pattern, repl, count))
                     else:
-                        log_msg = '  "{}" ➤ "{}" modified the source'.format(pattern, repl)
-        return css, log_msg
+                        log_msgs.append('  "{}" ➤ "{}" didn\'t modify the source'.format(pattern, repl))
+        return css, log_msgs
 
     def _log_file_creation(self, rel_path, css_path, css):
         src, dst = str(rel_path), str(css_path.relative_to(self._out_dir))
@@ -325,16 +824,56 @@ class SassGenerator:
         if c is None:
             progress_logger.info('%30s ➤ %-30s %7s', src, dst, fmt_size(size))
 
-    def _clever_imports(self, src_path):
-        _new_path = None
+    def _clever_imports(self, src_path, prev=None):
+        """
+        Resolve imports starting "SRC/", "NM/" and "DL/", relative imports are also resolved here so the files
+        imported are known for incremental builds.
+
+        Resolutions are remembered for the rest of the build and the contents of scss and css files are returned
+        from import_cache so partials imported by many files are only read once.
+        """
+        key = src_path, prev and os.path.dirname(prev)
+        if key not in self._resolved:
+            self._resolved[key] = self._resolve_import(src_path, prev)
+        resolved, fallback, tracked = self._resolved[key]
+
+        if not tracked:
+            # we can't tell which file libsass will find so the file has to be recompiled every time
+            self._deps = None
+        if resolved:
+            # libsass would treat indented syntax returned this way as scss, and imports of paths ending ".css"
+            # must stay plain css imports rather than being included
+            if resolved.suffix != '.sass' and not src_path.endswith('.css'):
+                source, signature = import_cache.read(resolved)
+                self._deps is not None and self._deps.setdefault(str(resolved), signature)
+                return [(str(resolved), source)]
+            # libsass reads the file itself
+            self._deps is not None and self._deps.setdefault(str(resolved), file_signature(resolved))
+        return fallback and [(fallback,)]
+
+    def _resolve_import(self, src_path, prev):
+        """
+        :return: tuple of (file imported if it can be found, path to return to libsass otherwise, whether the file
+          imported is known)
+        """
+        _new_path, relative = None, False
         if STARTS_SRC.match(src_path):
             _new_path = self._in_dir.joinpath(STARTS_SRC.sub('', src_path))
         elif self._nm and STARTS_NODE_M.match(src_path):
             _new_path = self._nm.joinpath(STARTS_NODE_M.sub('', src_path))
         elif self.download_root and STARTS_DOWNLOAD.match(src_path):
             _new_path = self.download_root.joinpath(STARTS_DOWNLOAD.sub('', src_path))
-
-        return _new_path and [(str(_new_path),)]
+        elif src_path.endswith('.css') or '://' in src_path or src_path.startswith('url('):
+            # plain css import which isn't compiled into the output
+            return None, None, True
+        elif prev and prev != 'stdin':
+            _new_path, relative = Path(prev).parent / src_path, True
+
+        resolved = _new_path and resolve_sass_import(_new_path)
+        # unresolved relative imports are left for libsass to search the include paths, for other imports
+        # libsass does the final resolution, returning "x.css" rather than "x" would cause a plain css import
+        fallback = None if relative and not resolved else _new_path and str(_new_path)
+        return resolved, fallback, bool(resolved)
 
     def _find_node_modules(self):
         for d in self._in_dir.parents:
@@ -0,0 +1,95 @@
+import os
+import shutil
+from pathlib import Path
+from typing import Any, Callable, Optional, Union
+from uuid import uuid4
+
+from .common import progress_logger
+
+MB = 1024 ** 2
+
+
+def cache_root(cache: Union[bool, str, Path]) -> Path:
+    """
+    Directory to use for caches, either the path given or the standard user cache directory if cache is True.
+    """
+    if cache is True:
+        return Path(os.getenv('XDG_CACHE_HOME') or Path.home() / '.cache') / 'grablib'
+    else:
+        return Path(cache).expanduser()
+
+
+class FileCache:
+    """
+    Directory of files named by a key (generally a hash of their content), once the directory exceeds max_size
+    the least recently used files are deleted.
+
+    Usage is recorded by updating the modification time of files since access times are unreliable.
+    """
+
+    def __init__(self, directory: Path, max_size: int):
+        self.directory = directory
+        self.max_size = max_size
+
+    def get(self, key: str) -> Optional[Path]:
+        path = self.directory / key
+        try:
+            os.utime(str(path))
+        except FileNotFoundError:
+            return
+        return path
+
+    def put(self, key: str, src: Path):
+        """
+        Copy src into the cache, files are copied to a temporary name then renamed so other processes sharing the
+        cache never see a partial file.
+        """
+        self._add(key, src.name, lambda tmp_path: shutil.copyfile(str(src), str(tmp_path)))
+
+    def put_bytes(self, key: str, data: bytes):
+        self._add(key, key, lambda tmp_path: tmp_path.write_bytes(data))
+
+    def _add(self, key: str, name: str, write: Callable[[Path], Any]):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.directory / '.{}.tmp'.format(uuid4().hex)
+        try:
+            write(tmp_path)
+            tmp_path.replace(self.directory / key)
+        except OSError as e:
+            # a cache failure shouldn't prevent downloading or building
+            progress_logger.warning('unable to add %s to cache: %s', name, e)
+            tmp_path.exists() and tmp_path.unlink()
+
+    def remove(self, key: str):
+        path = self.directory / key
+        path.exists() and path.unlink()
+
+    def evict(self) -> int:
+        """
+        Delete the least recently used files until the cache is no larger than max_size.
+
+        :return: number of files deleted
+        """
+        if not self.directory.exists():
+            return 0
+        files = []
+        for entry in os.scandir(str(self.directory)):
+            if entry.is_file() and not entry.name.startswith('.'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in files)
+        deleted = 0
+        for _, size, path in sorted(files):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                # deleted by another process sharing the cache
+                pass
+            else:
+                deleted += 1
+            total_size -= size
+        deleted and progress_logger.debug('%d files evicted from cache %s', deleted, self.directory)
+        return deleted
@@ -11,15 +11,20 @@ click.disable_unicode_literals_warning = True
 
 @click.command()
 @click.version_option(VERSION, '-V', '--version')
-@click.argument('action', type=click.Choice(['download', 'build']), required=False, metavar='[download / build]')
+@click.argument(
+    'action', type=click.Choice(['download', 'build', 'watch']), required=False, metavar='[download / build / watch]'
+)
 @click.option('-f', '--config-file', type=click.Path(exists=True, dir_okay=False, file_okay=True), required=False)
 @click.option('--debug/--no-debug', 'debug', default=None)
 @click.option('-v/-q', '--verbose/--quiet', 'verbose', default=None)
-def cli(action, config_file, debug, verbose):
+@click.option('-j', '--jobs', type=click.IntRange(min=1), default=None, help='number of files to download at once')
+@click.option('--paranoid', is_flag=True, help='hash every downloaded file to check it is unchanged')
+def cli(action, config_file, debug, verbose, jobs, paranoid):
     """
     Static asset management in python.
 
-    Called with no arguments grablib will download, then build. You can also choose to only download or build.
+    Called with no arguments grablib will download, then build. You can also choose to only download or build,
+    or to watch source files and rebuild as they change.
 
     See `grablib -h` and https://github.com/samuelcolvin/grablib for more help.
     """
@@ -33,11 +38,17 @@ def cli(action, config_file, debug, verbose):
 
     setup_logging(log_level)
     try:
-        grab = Grab(config_file, debug=debug)
+        grab = Grab(config_file, debug=debug, concurrency=jobs, paranoid=paranoid or None)
         if action in {'download', None}:
             grab.download()
         if action in {'build', None}:
             grab.build()
+        if action == 'watch':
+            try:
+                grab.watch()
+            except KeyboardInterrupt:
+                # Ctrl+C is how watching stops, interrupting download or build isn't a success so isn't caught
+                pass
     except GrablibError as e:
         click.secho('Error: %s' % e, fg='red')
         sys.exit(2)
@@ -0,0 +1,75 @@
+import gzip
+import shutil
+from pathlib import Path
+from typing import List, Union
+from uuid import uuid4
+
+from .common import GrablibError
+
+GZIP_CHUNK_SIZE = 256 * 1024
+
+
+def _gzip(src: Path, dst: Path):
+    # mtime=0 so the output only depends on the content
+    with src.open('rb') as f_in, dst.open('wb') as f_out:
+        with gzip.GzipFile(filename='', mode='wb', fileobj=f_out, compresslevel=9, mtime=0) as f_gz:
+            shutil.copyfileobj(f_in, f_gz, GZIP_CHUNK_SIZE)
+
+
+def _brotli(src: Path, dst: Path):
+    import brotli
+
+    dst.write_bytes(brotli.compress(src.read_bytes()))
+
+
+COMPRESSORS = {'gzip': ('.gz', _gzip), 'brotli': ('.br', _brotli)}
+
+
+def brotli_installed() -> bool:
+    try:
+        import brotli  # noqa: F401
+    except ImportError:
+        return False
+    else:
+        return True
+
+
+def compress_formats(compress: Union[bool, str, List[str]]) -> List[str]:
+    """
+    Find the formats to use from the "compress" build option, True means gzip and also brotli if it's installed.
+    """
+    if compress is True:
+        return ['gzip', 'brotli'] if brotli_installed() else ['gzip']
+    formats = [compress] if isinstance(compress, str) else list(compress or [])
+    for f in formats:
+        if f not in COMPRESSORS:
+            raise GrablibError('unknown compression format "{}", options are: {}'.format(f, ', '.join(COMPRESSORS)))
+    if 'brotli' in formats and not brotli_installed():
+        raise GrablibError('Error importing brotli, run `pip install brotli` to use brotli compression')
+    return formats
+
+
+def compress_file(path: Path, formats: List[str]) -> int:
+    """
+    Write compressed copies of path alongside it, eg. "foo.js.gz", copies newer than path are left alone.
+
+    :return: number of compressed files written
+    """
+    mtime = path.stat().st_mtime_ns
+    written = 0
+    for f in formats:
+        ext, compress = COMPRESSORS[f]
+        compressed_path = path.with_name(path.name + ext)
+        try:
+            if compressed_path.stat().st_mtime_ns > mtime:
+                continue
+        except FileNotFoundError:
+            pass
+        tmp_path = compressed_path.with_name('.{}.{}.tmp'.format(compressed_path.name, uuid4().hex))
+        try:
+            compress(path, tmp_path)
+            tmp_path.replace(compressed_path)
+        finally:
+            tmp_path.exists() and tmp_path.unlink()
+        written += 1
+    return written
@@ -1,15 +1,26 @@
 import hashlib
 import json
+import os
 import re
+import shutil
+import threading
+import time
 import zipfile
-from io import BytesIO as IO
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from functools import partial
 from pathlib import Path
-from typing import Union
+from typing import Optional, Tuple, Union
+from urllib.parse import quote, unquote
+from uuid import uuid4
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException
 
+from .cache import MB, FileCache, cache_root
 from .common import GrablibError, main_logger, progress_logger
+from .hashing import DEFAULT_ALGORITHM, Hasher, algorithm_of, check_algorithm, data_hash, file_hash
 
 ALIASES = {
     'GITHUB': 'https://raw.githubusercontent.com',
@@ -18,21 +29,144 @@ ALIASES = {
 ZIP_VALUE_REF = ':zip-lookup'
 ZIP_RAW_REF = ':zip-raw'
 STALE = ':stale'
+# cache validators saved in the lock file: lock name -> (response header, conditional request header)
+VALIDATORS = {':etag': ('ETag', 'If-None-Match'), ':last-modified': ('Last-Modified', 'If-Modified-Since')}
+CHUNK_SIZE = 64 * 1024
+# how failed requests are retried, can be overridden with "retry" in the config file
+RETRY_DEFAULTS = {
+    'attempts': 3,
+    'backoff': 0.5,
+    'statuses': [429, 500, 502, 503, 504],
+    'connect_timeout': 10,
+    'read_timeout': 60,
+}
+RETRY_EXCEPTIONS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+)
+MAX_RETRY_AFTER = 60
+FILENAME_REGEX = re.compile(r'/(?P<filename>[^/]+)$')
+REGEX_SPECIAL = set('.^$*+?{}[]\\|()')
 StrPath = Union[str, Path]
 
 
+def literal_prefix(pattern: str) -> str:
+    """
+    Find the literal string every string matched by pattern (with re.match) must start with, this is
+    conservative so can be shorter than the real prefix, eg. it's always empty if the pattern contains "|".
+    """
+    if '|' in pattern:
+        return ''
+    prefix = []
+    i = 1 if pattern.startswith('^') else 0
+    while i < len(pattern):
+        c, step = pattern[i], 1
+        if c == '\\':
+            c, step = pattern[i + 1 : i + 2], 2
+            if not c or c.isalnum():
+                # character class like \d, back reference or anchor
+                break
+        elif c in REGEX_SPECIAL:
+            break
+        quantifier = pattern[i + step : i + step + 1]
+        if quantifier in {'*', '?', '{'}:
+            # the character is optional
+            break
+        prefix.append(c)
+        if quantifier == '+':
+            break
+        i += step
+    return ''.join(prefix)
+
+
+class ZipLookup:
+    """
+    Find the first regex in a zip definition matching each file path in the archive.
+
+    Regexes are compiled once and a path is only tested against regexes whose literal prefix it starts with, so
+    most files in a large archive are rejected with a single str.startswith.
+    """
+
+    def __init__(self, value: dict):
+        self._lookups = [(literal_prefix(r), re.compile(r), r, targets) for r, targets in value.items()]
+        self._prefixes = tuple({prefix for prefix, *_ in self._lookups})
+
+    def match(self, filepath: str):
+        """
+        :return: tuple of (regex pattern, targets, match object) or None if no regex matches
+        """
+        if not filepath.startswith(self._prefixes):
+            return
+        for prefix, regex, pattern, targets in self._lookups:
+            if filepath.startswith(prefix):
+                m = regex.match(filepath)
+                if m:
+                    return pattern, targets, m
+
+
+class RetryableError(Exception):
+    """
+    Raised when a request fails in a way which might succeed if it's repeated, eg. "503 Service Unavailable".
+    """
+
+    def __init__(self, message: str, retry_after: float = 0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class ResumeError(Exception):
+    """
+    Raised when a partial download can't be resumed, eg. "416 Range Not Satisfiable", the part file is deleted.
+    """
+
+
+def parse_retry_after(value: Optional[str]) -> float:
+    """
+    Seconds to wait from a "Retry-After" header, only the delay-seconds form is supported.
+    """
+    try:
+        return min(max(float(value), 0), MAX_RETRY_AFTER)
+    except (TypeError, ValueError):
+        return 0
+
+
 class Downloader:
     """
     main class for downloading library files based on json file.
     """
 
     def __init__(
-        self, *, download_root: StrPath, download: dict, aliases: dict = None, lock: StrPath = '.grablib.lock', **data
+        self,
+        *,
+        download_root: StrPath,
+        download: dict,
+        aliases: dict = None,
+        lock: StrPath = '.grablib.lock',
+        concurrency: int = 1,
+        cache: Union[bool, StrPath] = None,
+        cache_max_size: int = 1024,
+        paranoid: bool = False,
+        retry: dict = None,
+        hash_algorithm: str = DEFAULT_ALGORITHM,
+        **data,
     ):
         """
         :param download_root: path to download file to
         :param downloads: dict of urls and paths to download from from > to
         :param aliases: extra aliases for download addresses
+        :param lock: path to lock file, None to not use a lock file
+        :param concurrency: maximum number of urls to download at once
+        :param cache: directory, or True for the user cache directory, to cache downloads in to share them between
+          projects, files are looked up in the cache by their hash in the lock file
+        :param cache_max_size: maximum size of the cache in MB, least recently used files are removed beyond this
+        :param paranoid: whether to hash every locked file to check it's unchanged, by default files whose size,
+          modification time and inode haven't changed since they were last hashed are assumed to be unchanged
+        :param retry: how to retry failed requests, overrides values in RETRY_DEFAULTS: "attempts", "backoff"
+          (seconds to wait before the first retry, doubled for each further retry), "statuses" (response status
+          codes to retry), "connect_timeout" and "read_timeout" (seconds, null for no timeout)
+        :param hash_algorithm: algorithm used to hash downloaded files, one of HASH_ALGORITHMS, each line of the lock
+          file records its algorithm so lock files using a different algorithm can still be checked
         """
         self.download_root = Path(download_root).absolute()
         self.download = download
@@ -41,10 +175,39 @@ class Downloader:
         self._downloaded = 0
         self._skipped = 0
         self._stale_deleted = 0
+        self._from_cache = 0
         self._lock_file = lock and Path(lock)
-        self._new_lock = []
-        self._current_lock = self._stale_files = None
+        # lock lines for each url are appended to the journal as soon as the url is done, so an interrupted run
+        # can carry on from where it stopped
+        self._journal_file = self._lock_file and self._lock_file.with_name(self._lock_file.name + '.journal')
+        self._journal = None
+        self._new_lock = {}
+        self._current_lock = self._stale_files = self._validators = None
+        self.retry = dict(RETRY_DEFAULTS, **(retry or {}))
+        unknown = self.retry.keys() - RETRY_DEFAULTS.keys()
+        if unknown:
+            raise GrablibError('unknown retry options: {}'.format(', '.join(sorted(unknown))))
+        if not isinstance(self.retry['attempts'], int) or self.retry['attempts'] < 1:
+            raise GrablibError('retry "attempts" must be an integer of at least 1')
+        if not isinstance(self.retry['backoff'], (int, float)) or self.retry['backoff'] < 0:
+            raise GrablibError('retry "backoff" must be a number of at least 0')
+        self.concurrency = concurrency
         self._session = requests.Session()
+        # enough connections to each host for every download thread, otherwise connections are discarded and
+        # reopened when threads download from the same host at once
+        adapter = HTTPAdapter(pool_maxsize=max(concurrency, 1))
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        # guards the lock bookkeeping and counters which are shared between download threads
+        self._mutex = threading.Lock()
+        self._cache = cache and FileCache(cache_root(cache) / 'downloads', cache_max_size * MB)
+        self.paranoid = paranoid
+        check_algorithm(hash_algorithm)
+        self.hash_algorithm = hash_algorithm
+        # stats of downloaded files used to avoid hashing them, it's kept beside the lock file since files whose stat
+        # matches aren't checked, without a lock file there are no hashes to check so it's not used
+        self._stat_cache_file = self._lock_file and self._lock_file.with_name(self._lock_file.name + '.stat')
+        self._stat_cache, self._old_stat_cache = {}, {}
 
     def __call__(self):
         """
@@ -52,43 +215,130 @@ class Downloader:
         """
         main_logger.info('downloading files to: %s', self.download_root)
 
-        self._current_lock, self._stale_files = self._read_lock()
-        for url_base, value in self.download.items():
-            url = self._setup_url(url_base)
-            try:
-                if isinstance(value, dict):
-                    self._process_zip(url, value)
-                else:
-                    self._process_normal_file(url, value)
-            except GrablibError as e:
-                # create new exception to show which file download went wrong for
-                raise GrablibError('Error downloading "{}" to "{}"'.format(url, value)) from e
+        self._current_lock, self._stale_files, self._validators = self._read_lock()
+        self._read_stat_cache()
+        with ExitStack() as stack:
+            if self._journal_file:
+                self._journal = stack.enter_context(self._journal_file.open('a'))
+            if self.concurrency > 1:
+                with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                    # results are consumed in definition order so the first error raised matches a serial run
+                    list(executor.map(self._process, self.download.keys(), self.download.values()))
+            else:
+                for url_base, value in self.download.items():
+                    self._process(url_base, value)
+        self._journal = None
         self._delete_stale()
         self._save_lock()
+        self._save_stat_cache()
+        self._cache and self._cache.evict()
         main_logger.info(
-            'Download finished: %d files downloaded, %d stale files deleted, %d existing and ignored',
+            'Download finished: %d files downloaded, %d copied from cache, %d stale files deleted, '
+            '%d existing and ignored',
             self._downloaded,
+            self._from_cache,
             self._stale_deleted,
             self._skipped,
         )
 
-    def _process_normal_file(self, url, dst):
-        new_path = self._file_path(url, dst, regex=r'/(?P<filename>[^/]+)$')
+    def _process(self, url_base, value):
+        url = self._setup_url(url_base)
+        try:
+            if isinstance(value, dict):
+                changed = self._process_zip(url, value)
+            else:
+                changed = self._process_normal_file(url, value)
+        except GrablibError as e:
+            # create new exception to show which file download went wrong for
+            raise GrablibError('Error downloading "{}" to "{}"'.format(url, value)) from e
+        # unchanged urls are already in the lock file
+        changed and self._journal_url(url)
+
+    def _journal_url(self, url: str):
+        """
+        Append the lock lines for url to the journal and fsync it, so url needn't be downloaded again if this run
+        is interrupted.
+        """
+        if not self._journal:
+            return
+        with self._mutex:
+            self._journal.write(''.join('{hash} {url} {name}\n'.format(**v) for v in self._new_lock.get(url, [])))
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+
+    def _process_normal_file(self, url, dst) -> bool:
+        """
+        :return: whether the file was downloaded or copied from the cache, False if it's unchanged
+        """
+        new_path = self._file_path(dst, FILENAME_REGEX.search(url))
         lock_hash, unchanged = self._file_exists_unchanged(url, new_path)
         if unchanged:
             self._lock(url, *self._current_lock[url])
-            self._skipped += 1
+            self._lock_validators(url, self._validators.get(url, {}))
+            with self._mutex:
+                self._skipped += 1
             progress_logger.debug('%s already exists unchanged, not downloading', url)
+            return False
+
+        cache_path = self._cache_lookup(lock_hash)
+        if cache_path:
+            progress_logger.info('copying from cache: %s ➤ %s...', url, new_path.relative_to(self.download_root))
+            tmp_path, remote_hash, validators = self._temp_path(), lock_hash, self._validators.get(url, {})
+            shutil.copyfile(str(cache_path), str(tmp_path))
+        else:
+            progress_logger.info('downloading: %s ➤ %s...', url, new_path.relative_to(self.download_root))
+            local_copy = lock_hash and self._find_local_copy(url)
+            tmp_path, remote_hash, validators = self._get_url(url, local_copy and self._validators.get(url), lock_hash)
+            if tmp_path is None:
+                progress_logger.info('  not modified, restoring from %s', local_copy.relative_to(self.download_root))
+                tmp_path, remote_hash = self._temp_path(), lock_hash
+                shutil.copyfile(str(local_copy), str(tmp_path))
+            elif lock_hash and not self._hash_matches(tmp_path, remote_hash, lock_hash):
+                tmp_path.unlink()
+                progress_logger.error('Security warning: hash of remote file %s has changed!', url)
+                raise GrablibError('remote hash mismatch')
+            self._cache and self._cache.put(self._cache_key(remote_hash), tmp_path)
+        new_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path.replace(new_path)
+        self._record_stat(new_path, remote_hash)
+        self._lock(url, str(new_path.relative_to(self.download_root)), remote_hash)
+        self._lock_validators(url, validators)
+        with self._mutex:
+            if cache_path:
+                self._from_cache += 1
+            else:
+                self._downloaded += 1
+        return True
+
+    def _cache_lookup(self, hash_) -> Optional[Path]:
+        """
+        Find a file in the cache with the given hash, the file's hash is checked in case the cache is corrupt.
+        """
+        cache_path = hash_ and self._cache and self._cache.get(self._cache_key(hash_))
+        if not cache_path:
             return
+        elif self._path_hash(cache_path, algorithm_of(hash_)) == hash_:
+            return cache_path
+        else:
+            progress_logger.warning('cached file %s does not match its hash, removing it', cache_path)
+            self._cache.remove(self._cache_key(hash_))
 
-        progress_logger.info('downloading: %s ➤ %s...', url, new_path.relative_to(self.download_root))
-        content = self._get_url(url)
-        remote_hash = self._data_hash(content)
-        if lock_hash and remote_hash != lock_hash:
-            progress_logger.error('Security warning: hash of remote file %s has changed!', url)
-            raise GrablibError('remote hash mismatch')
-        self._write(new_path, content, url)
-        self._downloaded += 1
+    @staticmethod
+    def _cache_key(hash_: str) -> str:
+        # ":" after the algorithm isn't valid in file names on windows
+        return hash_.replace(':', '-')
+
+    def _find_local_copy(self, url) -> Optional[Path]:
+        """
+        Find the file previously downloaded from url if it still exists unchanged, eg. when the destination has
+        been renamed. If so a conditional request can be made and the file restored from here if it's not modified.
+        """
+        name_hash = self._current_lock[url]
+        if isinstance(name_hash, tuple):
+            name, lock_hash = name_hash
+            path = self.download_root.joinpath(name)
+            if self._path_hash(path, algorithm_of(lock_hash)) == lock_hash:
+                return path
 
     def _file_exists_unchanged(self, url, path: Path):
         name_hash = self._current_lock.get(url)
@@ -97,63 +347,113 @@ class Downloader:
         name, lock_hash = name_hash
         if name != str(path.relative_to(self.download_root)):
             return lock_hash, False
-        file_hash = self._path_hash(path)
-        return lock_hash, file_hash == lock_hash
+        return lock_hash, self._path_hash(path, algorithm_of(lock_hash)) == lock_hash
 
-    def _process_zip(self, url, value):
-        value_hash = self._data_hash(json.dumps(value, sort_keys=True).encode())
-        lock_hash, unchanged = self._zip_exists_unchanged(url, value_hash)
+    def _process_zip(self, url, value) -> bool:
+        """
+        :return: whether the zip was downloaded or extracted from the cache, False if the files are unchanged
+        """
+        value_json = json.dumps(value, sort_keys=True).encode()
+        lock_hash, unchanged = self._zip_exists_unchanged(url, value_json)
         if unchanged:
             [self._lock(url, name, lock_hash) for name, lock_hash in self._current_lock[url]]
-            self._skipped += 1
+            self._lock_validators(url, self._validators.get(url, {}))
+            with self._mutex:
+                self._skipped += 1
             progress_logger.debug('%s already exists unchanged, not downloading', url)
-            return
-        progress_logger.info('downloading zip: %s...', url)
-        content = self._get_url(url)
-        remote_hash = self._data_hash(content)
-        if lock_hash and remote_hash != lock_hash:
-            progress_logger.error('Security warning: hash of remote file %s has changed!', url)
-            raise GrablibError('remote hash mismatch')
-        self._lock(url, ZIP_VALUE_REF, value_hash)
-        self._lock(url, ZIP_RAW_REF, remote_hash)
-        zcopied = self._extract_zip(url, content, value)
+            return False
+        cache_path = self._cache_lookup(lock_hash)
+        if cache_path:
+            progress_logger.info('extracting zip from cache: %s...', url)
+            zip_path, remote_hash, validators = cache_path, lock_hash, self._validators.get(url, {})
+        else:
+            progress_logger.info('downloading zip: %s...', url)
+            zip_path, remote_hash, validators = self._get_url(url, expected_hash=lock_hash)
+        try:
+            if lock_hash and not self._hash_matches(zip_path, remote_hash, lock_hash):
+                progress_logger.error('Security warning: hash of remote file %s has changed!', url)
+                raise GrablibError('remote hash mismatch')
+            self._lock(url, ZIP_VALUE_REF, data_hash(value_json, self.hash_algorithm))
+            self._lock(url, ZIP_RAW_REF, remote_hash)
+            self._lock_validators(url, validators)
+            zcopied = self._extract_zip(url, zip_path, value)
+            if not cache_path and self._cache:
+                self._cache.put(self._cache_key(remote_hash), zip_path)
+        finally:
+            if not cache_path:
+                zip_path.unlink()
         progress_logger.info('  %d files copied from zip archive', zcopied)
-        self._downloaded += 1
+        with self._mutex:
+            if cache_path:
+                self._from_cache += 1
+            else:
+                self._downloaded += 1
+        return True
 
-    def _extract_zip(self, url, content, value):
-        zipinmemory = IO(content)
+    def _extract_zip(self, url, zip_path: Path, value):
         zcopied = 0
-        with zipfile.ZipFile(zipinmemory) as zipf:
+        zip_lookup = ZipLookup(value)
+        with zipfile.ZipFile(str(zip_path)) as zipf:
             progress_logger.debug('%d files in zip archive', len(zipf.namelist()))
 
             for filepath in zipf.namelist():
                 if filepath.endswith('/'):
                     continue
-                regex_pattern, targets = None, None
-                for r, t in value.items():
-                    if re.match(r, filepath):
-                        regex_pattern, targets = r, t
-                        break
-                if regex_pattern is None:
+                lookup = zip_lookup.match(filepath)
+                if lookup is None:
                     progress_logger.debug('"%s" no target found', filepath)
-                elif targets is None:
+                    continue
+                regex_pattern, targets, m = lookup
+                if targets is None:
                     progress_logger.debug('"%s" skipping (regex: "%s")', filepath, regex_pattern)
                 else:
                     if isinstance(targets, str):
                         targets = [targets]
+                    new_paths = []
                     for target in targets:
-                        new_path = self._file_path(filepath, target, regex=regex_pattern)
+                        new_path = self._file_path(target, m)
                         progress_logger.debug(
                             '"%s" ➤ "%s" (regex: "%s")',
                             filepath,
                             new_path.relative_to(self.download_root),
                             regex_pattern,
                         )
-                        self._write(new_path, zipf.read(filepath), url)
-                        zcopied += 1
+                        new_paths.append(new_path)
+                    self._extract_member(zipf, filepath, new_paths, url)
+                    zcopied += len(new_paths)
         return zcopied
 
-    def _zip_exists_unchanged(self, url, value_hash):
+    def _extract_member(self, zipf: zipfile.ZipFile, filepath: str, new_paths: list, url: str):
+        """
+        Stream a file from the archive in chunks to all its destinations at once so it's only decompressed and
+        hashed once however many targets it has.
+        """
+        tmp_paths = []
+        hasher = Hasher(self.hash_algorithm)
+        try:
+            with ExitStack() as stack:
+                src = stack.enter_context(zipf.open(filepath))
+                files = []
+                for _ in new_paths:
+                    tmp_paths.append(self._temp_path())
+                    files.append(stack.enter_context(tmp_paths[-1].open('xb')))
+                for chunk in iter(partial(src.read, CHUNK_SIZE), b''):
+                    hasher.update(chunk)
+                    for f in files:
+                        f.write(chunk)
+        except BaseException:
+            for tmp_path in tmp_paths:
+                tmp_path.exists() and tmp_path.unlink()
+            raise
+
+        hash_ = hasher.hexdigest()
+        for tmp_path, new_path in zip(tmp_paths, new_paths):
+            new_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path.replace(new_path)
+            self._record_stat(new_path, hash_)
+            self._lock(url, str(new_path.relative_to(self.download_root)), hash_)
+
+    def _zip_exists_unchanged(self, url, value_json: bytes):
         name_hashes = self._current_lock.get(url)
         zip_hash = None
         if name_hashes is None:
@@ -164,10 +464,10 @@ class Downloader:
                 zip_hash = lock_hash
                 continue
             if name == ZIP_VALUE_REF:
-                file_hash = value_hash
+                current_hash = data_hash(value_json, algorithm_of(lock_hash))
             else:
-                file_hash = self._path_hash(self.download_root.joinpath(name))
-            if file_hash != lock_hash:
+                current_hash = self._path_hash(self.download_root.joinpath(name), algorithm_of(lock_hash))
+            if current_hash != lock_hash:
                 found_change = True
         return zip_hash, not found_change and zip_hash is not None
 
@@ -179,7 +479,7 @@ class Downloader:
             path = self.download_root.joinpath(name)
             if not path.exists():
                 continue
-            current_hash = self._path_hash(path)
+            current_hash = self._path_hash(path, algorithm_of(hash_))
             if current_hash == hash_:
                 progress_logger.info('deleting: %s which is stale...', name)
                 path.unlink()
@@ -199,11 +499,10 @@ class Downloader:
                 )
                 raise GrablibError('stale file modified')
 
-    def _file_path(self, src_path, dest, regex):
+    def _file_path(self, dest, m):
         """
-        check src_path complies with regex and generate new filename
+        generate new filename from dest and the groups of the regex match for the source path
         """
-        m = re.search(regex, src_path)
         if dest.endswith('/') or dest == '':
             dest += '{filename}'
         names = m.groupdict()
@@ -225,74 +524,317 @@ class Downloader:
             url_base = url_base.replace(name, value)
         return url_base
 
-    def _get_url(self, url):
+    def _get_url(
+        self, url, validators: dict = None, expected_hash: str = None
+    ) -> Tuple[Optional[Path], Optional[str], dict]:
+        """
+        Stream the response body into a ".part" file in download_root, hashing each chunk as it's written.
+
+        The part file is on the same file system as the destination so it can be renamed into place atomically.
+
+        If validators are supplied a conditional request is made, if the server responds with
+        "304 Not Modified" no file is created and the path and hash returned are None.
+
+        If expected_hash is known the part file is kept when the download fails, the next attempt then resumes
+        where it stopped with a Range request. If the part file already matches expected_hash it's used without a
+        request, if the download can't be resumed or the resumed file doesn't match expected_hash it's downloaded
+        again from the start.
+
+        Connection errors, timeouts and responses with a status in retry["statuses"] are retried with exponential
+        backoff, "Retry-After" is respected if it's longer.
+
+        :return: tuple of (path of the part file, hash of the content, validators from the response)
+        """
+        validators = validators or {}
+        part_path = self._part_path(url)
+        attempts = self.retry['attempts']
+        for attempt in range(1, attempts + 1):
+            try:
+                return self._download_part(url, part_path, validators, expected_hash)
+            except RetryableError as e:
+                if attempt >= attempts:
+                    progress_logger.error('Problem occurred during download: %s', e)
+                    raise GrablibError('request error') from e
+                delay = max(self.retry['backoff'] * 2 ** (attempt - 1), e.retry_after)
+                progress_logger.warning('  %s, retrying in %0.1fs, attempt %d of %d', e, delay, attempt + 1, attempts)
+                time.sleep(delay)
+
+    def _download_part(self, url, part_path: Path, validators: dict, expected_hash: Optional[str]):
+        part_hasher = None
+        if expected_hash and not validators and part_path.exists() and part_path.stat().st_size:
+            part_hasher = Hasher(self.hash_algorithm)
+            part_hasher.update_file(part_path)
+            hash_ = part_hasher.hexdigest()
+            if self._hash_matches(part_path, hash_, expected_hash):
+                # the last run stopped after the download finished but before the part file was renamed
+                progress_logger.info('  download already complete')
+                return part_path, hash_, self._validators.get(url, {})
+
+        keep_part = bool(expected_hash)
+        try:
+            path, hash_, new_validators = self._stream_url(url, part_path, validators, part_hasher, keep_part)
+        except ResumeError as e:
+            progress_logger.warning('  unable to resume download, %s, downloading from the start', e)
+            return self._stream_url(url, part_path, validators, None, keep_part)
+        if part_hasher and path and not self._hash_matches(path, hash_, expected_hash):
+            progress_logger.warning('  resumed download does not match the lock file, downloading again')
+            return self._stream_url(url, part_path, validators, None, keep_part)
+        return path, hash_, new_validators
+
+    def _stream_url(self, url, part_path: Path, validators: dict, part_hasher: Optional[Hasher], keep_part: bool):
+        """
+        Download url to part_path, if part_hasher is given it has hashed part_path and the download is resumed
+        from the end of part_path.
+        """
+        headers = {VALIDATORS[name][1]: value for name, value in validators.items()}
+        offset = None
+        if part_hasher:
+            offset = part_path.stat().st_size
+            headers['Range'] = 'bytes={}-'.format(offset)
         try:
-            r = self._session.get(url)
+            timeout = self.retry['connect_timeout'], self.retry['read_timeout']
+            with self._session.get(url, stream=True, headers=headers, timeout=timeout) as r:
+                new_validators = {name: r.headers[h] for name, (h, _) in VALIDATORS.items() if r.headers.get(h)}
+                if r.status_code == 304 and validators:
+                    progress_logger.debug('%s not modified', url)
+                    return None, None, dict(validators, **new_validators)
+
+                mode = self._write_mode(r, part_path, offset)
+                hasher = part_hasher if mode == 'ab' else Hasher(self.hash_algorithm)
+                with part_path.open(mode) as f:
+                    for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                        f.write(chunk)
+                        hasher.update(chunk)
+        except RETRY_EXCEPTIONS as e:
+            keep_part or not part_path.exists() or part_path.unlink()
+            raise RetryableError('{}: {}'.format(e.__class__.__name__, e)) from e
         except RequestException as e:
+            keep_part or not part_path.exists() or part_path.unlink()
             progress_logger.error('Problem occurred during download: %s: %s', e.__class__.__name__, e)
             raise GrablibError('request error') from e
+        except BaseException:
+            keep_part or not part_path.exists() or part_path.unlink()
+            raise
+        return part_path, hasher.hexdigest(), new_validators
+
+    def _write_mode(self, r, part_path: Path, offset: Optional[int]) -> str:
+        """
+        Check the status of a response, return the mode to open part_path with: "ab" to append to a partial
+        download, "wb" to write the whole file.
+        """
+        if r.status_code == 206 and offset is not None:
+            if not r.headers.get('Content-Range', '').startswith('bytes {}-'.format(offset)):
+                part_path.unlink()
+                raise ResumeError('unexpected Content-Range: {}'.format(r.headers.get('Content-Range')))
+            progress_logger.info('  resuming download after %d bytes', offset)
+            return 'ab'
+        elif r.status_code == 200:
+            # without a Range request or if the server ignored it the whole file is sent
+            return 'wb'
+        elif r.status_code in self.retry['statuses']:
+            retry_after = parse_retry_after(r.headers.get('Retry-After'))
+            raise RetryableError('status code {}'.format(r.status_code), retry_after)
+        elif offset is not None:
+            # eg. "416 Range Not Satisfiable"
+            part_path.unlink()
+            raise ResumeError('status code {}'.format(r.status_code))
         else:
-            if r.status_code != 200:
-                progress_logger.error('Wrong status code: %d', r.status_code)
-                raise GrablibError('Wrong status code')
-            return r.content
+            progress_logger.error('Wrong status code: %d', r.status_code)
+            raise GrablibError('Wrong status code')
 
-    def _write(self, new_path: Path, data: bytes, url: str):
-        new_path.parent.mkdir(parents=True, exist_ok=True)
-        new_path.write_bytes(data)
-        h = self._path_hash(new_path)
-        self._lock(url, str(new_path.relative_to(self.download_root)), h)
+    def _part_path(self, url) -> Path:
+        """
+        Path to download url to, it's named from the url so an interrupted download can be found and resumed.
+        """
+        self.download_root.mkdir(parents=True, exist_ok=True)
+        return self.download_root / '.grablib-{}.part'.format(hashlib.md5(url.encode()).hexdigest())
+
+    def _temp_path(self) -> Path:
+        self.download_root.mkdir(parents=True, exist_ok=True)
+        return self.download_root / '.grablib-{}.tmp'.format(uuid4().hex)
 
     def _lock(self, url: str, name: str, hash_: str):
         """
         Add details of the files downloaded to _new_lock so they can be saved to the lock file.
         Also remove path from _stale_files, whatever remains at the end therefore is stale and can be deleted.
         """
-        self._new_lock.append({'url': url, 'name': name, 'hash': hash_})
-        self._stale_files.pop(name, None)
+        with self._mutex:
+            self._new_lock.setdefault(url, []).append({'url': url, 'name': name, 'hash': hash_})
+            self._stale_files.pop(name, None)
+
+    def _lock_validators(self, url: str, validators: dict):
+        for name, value in validators.items():
+            # values such as Last-Modified contain spaces so are quoted to fit on one lock line
+            self._lock(url, name, quote(value, safe='"/,:=+'))
+
+    def _hash_matches(self, path: Path, hash_: str, expected_hash: str) -> bool:
+        """
+        Whether path, whose hash is hash_, has expected_hash which may be from a lock file using another algorithm.
+        """
+        algorithm = algorithm_of(expected_hash)
+        if algorithm != algorithm_of(hash_):
+            hash_ = file_hash(path, algorithm)
+        return hash_ == expected_hash
+
+    def _path_hash(self, path: Path, algorithm: str):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return
+        try:
+            name = str(path.relative_to(self.download_root))
+        except ValueError:
+            # not in download_root so not in the stat cache
+            name = None
+        cached = name and not self.paranoid and self._stat_cache.get(name)
+        if (
+            cached
+            and cached[:3] == [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+            and algorithm_of(cached[3]) == algorithm
+        ):
+            return cached[3]
+        hash_ = file_hash(path, algorithm)
+        if name:
+            self._stat_cache[name] = [stat.st_size, stat.st_mtime_ns, stat.st_ino, hash_]
+        return hash_
+
+    def _record_stat(self, path: Path, hash_: str):
+        """
+        Record the stat of a file just written so it needn't be hashed on the next run.
+        """
+        stat = path.stat()
+        self._stat_cache[str(path.relative_to(self.download_root))] = [
+            stat.st_size,
+            stat.st_mtime_ns,
+            stat.st_ino,
+            hash_,
+        ]
 
-    def _path_hash(self, path: Path):
-        if not path.exists():
+    def _read_stat_cache(self):
+        """
+        Read the stat cache, if it's missing, unreadable, corrupt or for another download_root every file is hashed.
+        """
+        if not self._stat_cache_file or not self._stat_cache_file.exists():
+            return
+        try:
+            with self._stat_cache_file.open() as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            progress_logger.warning('unable to read stat cache %s: %s', self._stat_cache_file, e)
             return
-        data = path.read_bytes()
-        return self._data_hash(data)
+        if not isinstance(data, dict) or data.get('download_root') != str(self.download_root):
+            return
+        files = data.get('files')
+        if isinstance(files, dict):
+            self._stat_cache = {
+                name: v
+                for name, v in files.items()
+                if isinstance(v, list)
+                and len(v) == 4
+                and all(isinstance(i, int) for i in v[:3])
+                and isinstance(v[3], str)
+            }
+            self._old_stat_cache = dict(self._stat_cache)
 
-    def _data_hash(self, data: bytes):
-        return hashlib.md5(data).hexdigest()
+    def _save_stat_cache(self):
+        if not self._stat_cache_file:
+            return
+        names = {v['name'] for vs in self._new_lock.values() for v in vs}
+        stat_cache = {name: v for name, v in self._stat_cache.items() if name in names}
+        if stat_cache == self._old_stat_cache:
+            return
+        try:
+            with self._stat_cache_file.open('w') as f:
+                json.dump({'download_root': str(self.download_root), 'files': stat_cache}, f)
+        except OSError as e:
+            # the cache only saves time, failing to write it shouldn't fail the download
+            progress_logger.warning('unable to write stat cache %s: %s', self._stat_cache_file, e)
 
     def _read_lock(self) -> tuple:
-        current_lock, stale_files = {}, {}
-        comment = re.compile('^ *#')
-        if self._lock_file and self._lock_file.exists():
-            with self._lock_file.open() as f:
-                for line in f:
-                    if comment.match(line):
-                        continue
-                    hash_, url, name = line.strip('\n').split(' ')
-                    v = name, hash_
-                    existing_v = current_lock.get(url)
-                    if existing_v is None:
-                        # if current_lock doesn't contain url add it as a single tuple
-                        current_lock[url] = v
-                    elif isinstance(existing_v, tuple):
-                        # if current_lock[url] is just a single tuple convert it to a list of tuples and append v
-                        current_lock[url] = [existing_v, v]
-                    else:
-                        # if current_lock[url] is already a list append v to that list
-                        # existing_v is mutable so this is equivalent to current_lock[url] += [v]
-                        existing_v.append(v)
+        current_lock, stale_files, validators = {}, {}, {}
+        entries = self._read_lock_file(self._lock_file)
+        journal = self._read_journal()
+        if journal:
+            progress_logger.info('resuming interrupted download, %d urls already complete', len(journal))
+            # files from the lock and earlier runs for urls in the journal may now be stale
+            journal_entries = self._read_lock_file(self._journal_file, skip_invalid=True)
+            stale_files.update({name: hash_ for hash_, url, name in entries + journal_entries if url in journal})
+            entries = [e for e in entries if e[1] not in journal]
+            entries += [(hash_, url, name) for url, names in journal.items() for name, hash_ in names.items()]
+
+        algorithms = set()
+        for hash_, url, name in entries:
+            if name in VALIDATORS:
+                validators.setdefault(url, {})[name] = unquote(hash_)
+                continue
+            algorithms.add(algorithm_of(hash_))
+            v = name, hash_
+            existing_v = current_lock.get(url)
+            if existing_v is None:
+                # if current_lock doesn't contain url add it as a single tuple
+                current_lock[url] = v
+            elif isinstance(existing_v, tuple):
+                # if current_lock[url] is just a single tuple convert it to a list of tuples and append v
+                current_lock[url] = [existing_v, v]
+            else:
+                # if current_lock[url] is already a list append v to that list
+                # existing_v is mutable so this is equivalent to current_lock[url] += [v]
+                existing_v.append(v)
+
+        # eg. an xxhash algorithm used by someone else when xxhash isn't installed here
+        for algorithm in algorithms:
+            check_algorithm(algorithm)
 
         for name_hashes in current_lock.values():
             if isinstance(name_hashes, tuple):
                 name_hashes = [name_hashes]
             stale_files.update({name: hash_ for name, hash_ in name_hashes})
-        return current_lock, stale_files
+        return current_lock, stale_files, validators
+
+    @staticmethod
+    def _read_lock_file(path: Optional[Path], skip_invalid=False) -> list:
+        """
+        Read (hash, url, name) tuples from a lock file.
+
+        :param skip_invalid: whether to skip invalid lines rather than raise an error, the journal's last line may
+          be incomplete if the run was interrupted
+        """
+        if not path or not path.exists():
+            return []
+        comment = re.compile('^ *#')
+        entries = []
+        with path.open() as f:
+            for line in f:
+                if comment.match(line):
+                    continue
+                entry = tuple(line.strip('\n').split(' '))
+                if len(entry) != 3:
+                    if skip_invalid:
+                        continue
+                    raise GrablibError('invalid line in "{}": {!r}'.format(path, line))
+                entries.append(entry)
+        return entries
+
+    def _read_journal(self) -> dict:
+        """
+        Read the journal left by an interrupted run, later lines for a url replace earlier ones since the url
+        was completed again by a later run.
+
+        :return: dict of url -> {name: hash}
+        """
+        journal, prev_url = {}, None
+        for hash_, url, name in self._read_lock_file(self._journal_file, skip_invalid=True):
+            if url != prev_url:
+                journal[url] = {}
+            journal[url][name] = hash_
+            prev_url = url
+        return journal
 
     def _save_lock(self):
         if self._lock_file is None:
             return
-        self._new_lock.sort(key=lambda v: (v['url'], v['name']))
-        text = '\n'.join('{hash} {url} {name}'.format(**v) for v in self._new_lock)
+        new_lock = sorted((v for vs in self._new_lock.values() for v in vs), key=lambda v: (v['url'], v['name']))
+        text = '\n'.join('{hash} {url} {name}'.format(**v) for v in new_lock)
         if self._stale_files:
             if text:
                 text += '\n'
@@ -302,4 +844,19 @@ class Downloader:
             )
             text += '\n'.join('{} {} {}'.format(h, STALE, n) for n, h in sorted(self._stale_files.items()))
         text += '\n'
-        self._lock_file.write_text(text)
+        try:
+            unchanged = self._lock_file.read_text() == text
+        except FileNotFoundError:
+            unchanged = False
+        if not unchanged:
+            # the lock file is replaced in one step so it's never partially written, then the journal isn't required
+            tmp_path = self._lock_file.with_name('.{}.{}.tmp'.format(self._lock_file.name, uuid4().hex))
+            try:
+                with tmp_path.open('w') as f:
+                    f.write(text)
+                    f.flush()
+                    os.fsync(f.fileno())
+                tmp_path.replace(self._lock_file)
+            finally:
+                tmp_path.exists() and tmp_path.unlink()
+        self._journal_file.exists() and self._journal_file.unlink()
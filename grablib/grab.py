@@ -7,19 +7,30 @@ from ruamel.yaml import YAML, YAMLError
 from .build import Builder
 from .common import GrablibError, main_logger
 from .download import Downloader
+from .watch import Watcher
 
 STD_FILE_NAMES = [re.compile(r'grablib\.ya?ml'), re.compile(r'grablib\.json')]
 yaml = YAML(typ='safe')
 
 
 class Grab:
-    def __init__(self, config_file: str = None, *, download_root: str = None, debug=None):
+    def __init__(
+        self,
+        config_file: str = None,
+        *,
+        download_root: str = None,
+        debug=None,
+        concurrency: int = None,
+        paranoid: bool = None,
+    ):
         """
         Process a file or json string defining files to download and what to do with them.
 
         :param config_file: relative path to file defining what to download
         :param download_root: root_directory to download to
         :param debug: whether to run in debug mode
+        :param concurrency: number of files to download at once, overrides "concurrency" from the config file
+        :param paranoid: whether to hash every downloaded file to check it's unchanged
         """
         if config_file:
             config_path = Path(config_file).resolve()
@@ -36,6 +47,10 @@ class Grab:
             self.config_data['download_root'] = download_root
         if debug is not None:
             self.config_data['debug'] = debug
+        if concurrency is not None:
+            self.config_data['concurrency'] = concurrency
+        if paranoid is not None:
+            self.config_data['paranoid'] = paranoid
 
     def download(self):
         if 'download' not in self.config_data:
@@ -51,6 +66,13 @@ class Grab:
         build = Builder(**self.config_data)
         build()
 
+    def watch(self):
+        if 'build' not in self.config_data:
+            main_logger.warning('watch called with no "build" info available')
+            return
+        watcher = Watcher(Builder(**self.config_data))
+        watcher.run()
+
     @classmethod
     def yaml_or_json(cls, file_path: Path):
         if file_path.name.endswith(('.yml', '.yaml')):
@@ -0,0 +1,78 @@
+import hashlib
+from functools import partial
+from pathlib import Path
+
+from .common import GrablibError
+
+HASHLIB_ALGORITHMS = 'md5', 'sha1', 'sha256', 'sha512', 'blake2b', 'blake2s'
+XXHASH_ALGORITHMS = 'xxh64', 'xxh3_64', 'xxh128'
+HASH_ALGORITHMS = HASHLIB_ALGORITHMS + XXHASH_ALGORITHMS
+# md5 hashes aren't prefixed with their algorithm so lock files from before algorithms could be chosen are valid
+DEFAULT_ALGORITHM = 'md5'
+READ_BUFFER_SIZE = 1024 * 1024
+
+
+def check_algorithm(algorithm: str):
+    if algorithm not in HASH_ALGORITHMS:
+        raise GrablibError('unknown hash algorithm "{}", options are: {}'.format(algorithm, ', '.join(HASH_ALGORITHMS)))
+    if algorithm in XXHASH_ALGORITHMS:
+        try:
+            import xxhash  # noqa: F401
+        except ImportError:
+            raise GrablibError('Error importing xxhash, run `pip install xxhash` to use "{}"'.format(algorithm))
+
+
+def algorithm_of(hash_: str) -> str:
+    """
+    Find the algorithm used for a hash from a lock file, eg. "sha256:2c26b4..." -> "sha256", "acbd18db..." -> "md5".
+    """
+    algorithm, sep, _ = hash_.rpartition(':')
+    return algorithm if sep else DEFAULT_ALGORITHM
+
+
+class Hasher:
+    """
+    Incrementally hash data with any of HASH_ALGORITHMS, the result is in the form used in lock files.
+    """
+
+    def __init__(self, algorithm: str = DEFAULT_ALGORITHM):
+        self.algorithm = algorithm
+        if algorithm in XXHASH_ALGORITHMS:
+            import xxhash
+
+            self._hasher = getattr(xxhash, algorithm)()
+        else:
+            self._hasher = hashlib.new(algorithm)
+
+    def update(self, data: bytes):
+        self._hasher.update(data)
+
+    def update_file(self, path: Path):
+        """
+        Hash the contents of path, it's read in chunks into the same buffer so memory use doesn't depend on the
+        size of the file.
+        """
+        buffer = bytearray(READ_BUFFER_SIZE)
+        view = memoryview(buffer)
+        with path.open('rb', buffering=0) as f:
+            for size in iter(partial(f.readinto, buffer), 0):
+                self._hasher.update(view[:size])
+
+    def hexdigest(self) -> str:
+        """
+        Hex digest prefixed with the algorithm unless it's md5, eg. "sha256:2c26b4...".
+        """
+        digest = self._hasher.hexdigest()
+        return digest if self.algorithm == DEFAULT_ALGORITHM else '{}:{}'.format(self.algorithm, digest)
+
+
+def data_hash(data: bytes, algorithm: str = DEFAULT_ALGORITHM) -> str:
+    hasher = Hasher(algorithm)
+    hasher.update(data)
+    return hasher.hexdigest()
+
+
+def file_hash(path: Path, algorithm: str = DEFAULT_ALGORITHM) -> str:
+    hasher = Hasher(algorithm)
+    hasher.update_file(path)
+    return hasher.hexdigest()
@@ -0,0 +1,93 @@
+import re
+from typing import Dict, List, Optional, Tuple
+
+REGEX_META = set('.^$*+?{}[]|()')
+
+
+def literal_value(pattern: str) -> Optional[str]:
+    """
+    The string a regex matches if it only matches one string, eg. "\\.\\./img" -> "../img", otherwise None.
+    """
+    chars, escaped = [], False
+    for c in pattern:
+        if escaped:
+            if c.isalnum():
+                # "\d", "\b", "\1" etc.
+                return
+            chars.append(c)
+            escaped = False
+        elif c == '\\':
+            escaped = True
+        elif c in REGEX_META:
+            return
+        else:
+            chars.append(c)
+    if escaped or not chars:
+        return
+    return ''.join(chars)
+
+
+def overlaps(a: str, b: str) -> bool:
+    """
+    Whether a match of a and a match of b (or the text b) could share any characters.
+    """
+    if a in b or b in a:
+        return True
+    return any(a.endswith(b[:i]) or b.endswith(a[:i]) for i in range(1, min(len(a), len(b))))
+
+
+class Replacer:
+    """
+    Ordered regex replacement rules compiled once and applied with the same result as calling re.sub for each rule
+    in turn.
+
+    Consecutive rules matching plain strings are applied together in one pass over the content with a single
+    alternation if they can't affect each other: none of their patterns overlap and no pattern can match text
+    produced by an earlier rule in the group.
+    """
+
+    def __init__(self, rules: Dict[str, str]):
+        self.rules = list(rules.items())
+        self._steps = []
+        group = None
+        for index, (pattern, repl) in enumerate(self.rules):
+            literal = literal_value(pattern)
+            if literal is None or '\\' in repl:
+                group = None
+                self._steps.append((re.compile(pattern), repl, index))
+            elif group is not None and all(
+                not overlaps(literal, other) and not overlaps(literal, other_repl)
+                for other, (other_repl, _) in group.items()
+            ):
+                group[literal] = repl, index
+            else:
+                group = {literal: (repl, index)}
+                self._steps.append(group)
+
+        # groups of one rule are applied like any other rule
+        for i, step in enumerate(self._steps):
+            if isinstance(step, dict):
+                if len(step) == 1:
+                    ((literal, (repl, index)),) = step.items()
+                    self._steps[i] = re.compile(re.escape(literal)), repl, index
+                else:
+                    regex = re.compile('|'.join(re.escape(literal) for literal in step))
+                    self._steps[i] = regex, step, None
+
+    def __call__(self, content: str) -> Tuple[str, List[int]]:
+        """
+        :return: tuple of (new content, number of replacements made by each rule)
+        """
+        counts = [0] * len(self.rules)
+        for regex, repl, index in self._steps:
+            if index is None:
+                content = regex.sub(lambda m: self._group_repl(m, repl, counts), content)
+            else:
+                content, counts[index] = regex.subn(repl, content)
+        return content, counts
+
+    @staticmethod
+    def _group_repl(m, group, counts):
+        repl, index = group[m.group()]
+        counts[index] += 1
+        return repl
@@ -0,0 +1,58 @@
+import json
+from typing import List
+
+BASE64_CHARS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+
+
+def vlq_encode(*values: int) -> str:
+    """
+    Encode integers as base64 variable length quantities as used in source map mappings.
+    """
+    chars = []
+    for value in values:
+        value = (-value << 1) | 1 if value < 0 else value << 1
+        while True:
+            digit, value = value & 31, value >> 5
+            chars.append(BASE64_CHARS[digit | 32 if value else digit])
+            if not value:
+                break
+    return ''.join(chars)
+
+
+class SourceMap:
+    """
+    Version 3 source map built up line by line as files are concatenated, each generated line maps to the start of
+    a line in a source file.
+    """
+
+    def __init__(self, file: str):
+        self.file = file
+        self.sources: List[str] = []
+        self._lines: List[str] = []
+        # source index and line of the previous segment, the values in mappings are relative to these
+        self._prev_source = self._prev_line = 0
+
+    def add_source(self, path: str) -> int:
+        self.sources.append(path)
+        return len(self.sources) - 1
+
+    def add_lines(self, source: int, count: int, first_line: int = 0, minified: bool = False):
+        """
+        Map the next count generated lines to lines of source starting at first_line, minified sources don't have
+        lines matching the original so every line is mapped to first_line.
+        """
+        for i in range(count):
+            line = first_line if minified else first_line + i
+            self._lines.append(vlq_encode(0, source - self._prev_source, line - self._prev_line, 0))
+            self._prev_source, self._prev_line = source, line
+
+    def skip_lines(self, count: int):
+        """
+        Add generated lines which don't come from a source, eg. the banner before each file.
+        """
+        self._lines.extend([''] * count)
+
+    def dumps(self) -> str:
+        return json.dumps(
+            {'version': 3, 'file': self.file, 'sources': self.sources, 'names': [], 'mappings': ';'.join(self._lines)}
+        )
@@ -0,0 +1,176 @@
+import os
+import queue
+import shutil
+import threading
+from pathlib import Path
+from typing import Dict, Set, Tuple
+
+from .build import SASS_EXTENSIONS, Builder
+from .common import GrablibError, main_logger, progress_logger
+
+
+class Watcher:
+    """
+    Watch the sources of a build and rebuild only the cat destinations and sass directories affected by changes.
+
+    The same builder is used for every build so jsmin, sass and the caches used while building stay loaded. File
+    system events come from watchdog if it's installed, otherwise files are polled.
+    """
+
+    def __init__(self, builder: Builder, *, debounce: float = 0.2, poll_interval: float = 0.5):
+        """
+        :param builder: builder to use for all builds
+        :param debounce: seconds to wait for further changes before rebuilding
+        :param poll_interval: seconds between checking files when watchdog isn't installed
+        """
+        self.builder = builder
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+
+        self.cat_data = {k: v for k, v in (builder.build.get('cat') or {}).items() if isinstance(v, list)}
+        self.cat_sources: Dict[Path, Set[str]] = {}
+        for dest, srcs in self.cat_data.items():
+            for src in srcs:
+                path = builder._file_path(src if isinstance(src, str) else src['src'])
+                self.cat_sources.setdefault(path, set()).add(dest)
+
+        self.sass_data, self.sass_dirs = {}, {}
+        for dest, d in (builder.build.get('sass') or {}).items():
+            d = {'src': d} if isinstance(d, str) else d
+            # only files which have changed need compiling
+            self.sass_data[dest] = dict(d, incremental=d.get('incremental', True))
+            self.sass_dirs[dest] = builder._file_path(d['src'])
+
+        self.roots = set(self.sass_dirs.values())
+        builder.download_root and self.roots.add(builder.download_root)
+
+    def run(self):
+        """
+        Build everything, then rebuild as files change until stop() is called.
+        """
+        wipe_data = self.builder.build.get('wipe')
+        wipe_data and self.builder.wipe(wipe_data)
+        self.rebuild(cat_dests=set(self.cat_data), sass_dests=set(self.sass_data))
+        main_logger.info('watching %d directories and %d files for changes', len(self.roots), len(self.cat_sources))
+
+        try:
+            from watchdog.observers import Observer
+        except ImportError:
+            progress_logger.debug('watchdog not installed, polling for changes')
+            wait = self._poll()
+        else:
+            wait = self._observe(Observer())
+
+        for changes in wait:
+            cat_dests, sass_dests = self.affected(changes)
+            if cat_dests or sass_dests:
+                main_logger.info('%d files changed, rebuilding', len(changes))
+                self.rebuild(cat_dests=cat_dests, sass_dests=sass_dests)
+
+    def stop(self):
+        self._stop.set()
+
+    def affected(self, changes: Set[Path]) -> Tuple[Set[str], Set[str]]:
+        """
+        Find the cat destinations and sass directories which need rebuilding after changes.
+        """
+        cat_dests, sass_dests = set(), set()
+        for path in changes:
+            if path == self.builder.build_root or self.builder.build_root in path.parents:
+                continue
+            cat_dests.update(self.cat_sources.get(path, ()))
+            if path.suffix in SASS_EXTENSIONS:
+                dests = {dest for dest, d in self.sass_dirs.items() if d in path.parents}
+                # files outside the sass directories may be imported from any of them, eg. via "DL/"
+                sass_dests.update(dests or self.sass_dirs)
+        return cat_dests, sass_dests
+
+    def rebuild(self, *, cat_dests: Set[str], sass_dests: Set[str]):
+        try:
+            cat_dests and self.builder.cat({k: v for k, v in self.cat_data.items() if k in cat_dests})
+            if sass_dests:
+                if self.builder.debug:
+                    # debug builds copy sources to "<dest>/.src" which must not exist, it's left by the last build
+                    for dest in sass_dests:
+                        shutil.rmtree(str(self.builder._dest_path(dest) / '.src'), ignore_errors=True)
+                self.builder.sass({k: v for k, v in self.sass_data.items() if k in sass_dests})
+        except (GrablibError, OSError) as e:
+            # errors shouldn't stop watching, the next change might fix them, eg. a source deleted by "git checkout"
+            main_logger.error('Error: %s', e)
+
+    def snapshot(self) -> Dict[Path, Tuple[int, int]]:
+        """
+        Modification time and size of every file being watched.
+        """
+        files = {}
+        for path in self.cat_sources:
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                pass
+            else:
+                files[path] = stat.st_mtime_ns, stat.st_size
+
+        dirs = [str(r) for r in self.roots]
+        build_root = str(self.builder.build_root)
+        while dirs:
+            try:
+                entries = list(os.scandir(dirs.pop()))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            for entry in entries:
+                if entry.is_dir():
+                    entry.path != build_root and dirs.append(entry.path)
+                elif entry.is_file():
+                    stat = entry.stat()
+                    files[Path(entry.path)] = stat.st_mtime_ns, stat.st_size
+        return files
+
+    def _poll(self):
+        """
+        Compare snapshots of the files being watched, yielding the paths changed once changes stop for "debounce".
+        """
+        previous = self.snapshot()
+        changes = set()
+        while not self._stop.wait(self.debounce if changes else self.poll_interval):
+            current = self.snapshot()
+            new_changes = {p for p in previous.keys() | current.keys() if previous.get(p) != current.get(p)}
+            previous = current
+            if new_changes:
+                changes |= new_changes
+            elif changes:
+                yield changes
+                changes = set()
+
+    def _observe(self, observer):
+        """
+        Use watchdog to get file system events, yielding the paths changed once events stop for "debounce".
+        """
+        from watchdog.events import FileSystemEventHandler
+
+        events = queue.Queue()
+
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                events.put(event.src_path)
+                getattr(event, 'dest_path', None) and events.put(event.dest_path)
+
+        handler = Handler()
+        for root in self.roots:
+            root.is_dir() and observer.schedule(handler, str(root), recursive=True)
+        for path in {p.parent for p in self.cat_sources}:
+            path.is_dir() and observer.schedule(handler, str(path), recursive=False)
+        observer.start()
+        try:
+            changes = set()
+            while not self._stop.is_set():
+                try:
+                    changes.add(Path(events.get(timeout=self.debounce if changes else self.poll_interval)))
+                except queue.Empty:
+                    if changes:
+                        yield changes
+                        changes = set()
+        finally:
+            observer.stop()
+            observer.join()
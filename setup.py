@@ -55,5 +55,11 @@ setup(
             'jsmin>=2.2.1',
             'libsass>=0.14.4',
         ],
+        'watch': [
+            'watchdog>=0.9',
+        ],
+        'xxhash': [
+            'xxhash>=2.0',
+        ],
     }
 )
@@ -1,5 +1,9 @@
 import builtins
+import gzip
 import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 import pytest
@@ -7,8 +11,8 @@ from pytest_toolbox import gettree, mktree
 from pytest_toolbox.comparison import RegexStr
 
 from grablib import Grab
-from grablib.build import SassGenerator, fmt_size, insert_hash
-from grablib.common import GrablibError, setup_logging
+from grablib.build import ImportCache, SassGenerator, fmt_size, insert_hash, write_if_changed
+from grablib.common import GrablibError, main_logger, setup_logging
 
 real_import = builtins.__import__
 
@@ -322,6 +326,24 @@ def test_rm_some(tmpworkdir):
     assert {'foo': {'bar.js': 'x'}, 'remain.txt': 'y'} == gettree(tmpworkdir.join('built_at'))
 
 
+def test_rm_flags(tmpworkdir):
+    mktree(
+        tmpworkdir,
+        {
+            'grablib.yml': """
+        build_root: "built_at"
+        build:
+          wipe:
+          - (?i)foo.*
+          - sub
+        """,
+            'built_at': {'FOO.txt': 'x', 'foo': {'bar.js': 'x'}, 'sub': {'a.txt': 'x'}, 'remain.txt': 'y'},
+        },
+    )
+    Grab().build()
+    assert {'remain.txt': 'y'} == gettree(tmpworkdir.join('built_at'))
+
+
 def test_jsmin_import_error(mocker, tmpworkdir):
     mktree(
         tmpworkdir,
@@ -415,6 +437,29 @@ def test_sass_clever_import(tmpworkdir):
     assert {'foo.css': 'a{color:black}.x{width:100px}\n'} == gettree(tmpworkdir.join('built_at/css'))
 
 
+def test_sass_clever_import_plain_css(tmpworkdir):
+    mktree(
+        tmpworkdir,
+        {
+            'grablib.yml': """
+        download_root: downloaded2
+        build_root: built_at
+        debug: false
+        build:
+          sass:
+            css: sass_dir
+        """,
+            'downloaded2': {'x.css': '.x {width:100px}'},
+            'sass_dir': {'foo.scss': "@import 'DL/x.css';\na {color: black;}"},
+        },
+    )
+    Grab().build()
+    css = tmpworkdir.join('built_at/css/foo.css').read()
+    assert css.startswith('@import url(')
+    assert 'x.css' in css
+    assert 'width' not in css
+
+
 def test_sass_clever_import_debug(tmpworkdir):
     mktree(
         tmpworkdir,
@@ -617,3 +662,560 @@ def test_hash_bytes():
 def test_other_algorithm():
     assert insert_hash(Path('foo.css'), 'x') == Path('foo.9dd4e46.css')
     assert insert_hash(Path('foo.css'), 'x', hash_algorithm=hashlib.sha1) == Path('foo.11f6ad8.css')
+
+
+def test_sass_workers(mocker, tmpworkdir):
+    mktree(
+        tmpworkdir,
+        {
+            'grablib.yml': """
+        build_root: "built_at"
+        build:
+          sass:
+            css:
+              src: sass_dir
+              workers: 2
+        """,
+            'sass_dir': {
+                'adir': {'_mixin.scss': '$colour: red;', 'bb.scss': "@import 'mixin';\nb {color: $colour}"},
+                'aa.scss': 'a {color: white}',
+                'cc.scss': 'c {color: black}',
+            },
+        },
+    )
+    log_file_creation = mocker.spy(SassGenerator, '_log_file_creation')
+    Grab().build()
+    assert gettree(tmpworkdir.join('built_at')) == {
+        'css': {'aa.css': 'a{color:white}\n', 'adir': {'bb.css': 'b{color:red}\n'}, 'cc.css': 'c{color:black}\n'}
+    }
+    assert [str(c[0][1]) for c in log_file_creation.call_args_list] == ['aa.scss', 'adir/bb.scss', 'cc.scss']
+
+
+def test_sass_workers_error(tmpworkdir):
+    mktree(
+        tmpworkdir,
+        {
+            'grablib.yml': """
+        build_root: "built_at"
+        build:
+          sass:
+            css:
+              src: sass_dir
+              workers: 2
+        """,
+            'sass_dir': {'foo.scss': '.foo { WRONG', 'bar.scss': 'a {color: black}'},
+        },
+    )
+    with pytest.raises(GrablibError):
+        Grab().build()
+    assert gettree(tmpworkdir.join('built_at')) == {'css': {'bar.css': 'a{color:black}\n'}}
+
+
+def test_sass_incremental(mocker, tmpworkdir):
+    mktree(
+        tmpworkdir,
+        {
+            'grablib.yml': """
+        build_root: "built_at"
+        cache: the_cache
+        build:
+          sass:
+            css:
+              src: sass_dir
+              incremental: true
+        """,
+            'sass_dir': {
+                'adir': {'_mixin.scss': '$colour: red;', 'bb.scss': "@import 'mixin';\nb {color: $colour}"},
+                'aa.scss': 'a {color: white}',
+            },
+        },
+    )
+    generate_css = mocker.spy(SassGenerator, 'generate_css')
+    Grab().build()
+    assert generate_css.call_count == 2
+    assert gettree(tmpworkdir.join('built_at')) == {
+        'css': {'aa.css': 'a{color:white}\n', 'adir': {'bb.css': 'b{color:red}\n'}}
+    }
+
+    Grab().build()
+    assert generate_css.call_count == 2
+
+    tmpworkdir.join('sass_dir/adir/_mixin.scss').write('$colour: blue;')
+    Grab().build()
+    assert [c[0][1].name for c in generate_css.call_args_list[2:]] == ['bb.scss']
+    assert gettree(tmpworkdir.join('built_at')) == {
+        'css': {'aa.css': 'a{color:white}\n', 'adir': {'bb.css': 'b{color:blue}\n'}}
+    }
+
+    tmpworkdir.join('built_at/css/aa.css').remove()
+    Grab().build()
+    assert [c[0][1].name for c in generate_css.call_args_list[3:]] == ['aa.scss']
+    assert tmpworkdir.join('built_at/css/aa.css').read() == 'a{color:white}\n'
+
+
+def test_sass_incremental_unresolved(mocker, tmpworkdir):
+    mktree(
+        tmpworkdir,
+        {
+            'grablib.yml': """
+        build_root: "built_at"
+        cache: the_cache
+        build:
+          sass:
+            css:
+              src: sass_dir
+              incremental: true
+        """,
+            'sass_dir': {'foo.scss': "@import 'plain.css';\n@import 'other';\na {color: white}"},
+            'other.scss': 'b {color: black}',
+        },
+    )
+    generate_css = mocker.spy(SassGenerator, 'generate_css')
+    Grab().build()
+    Grab().build()
+    # "other" is found by libsass in the working directory so foo.scss's imports aren't known
+    assert generate_css.call_count == 2
+    assert tmpworkdir.join('built_at/css/foo.css').read() == '@import url(plain.css);b{color:black}a{color:white}\n'
+
+
+def test_sass_incremental_invalid_manifest(mocker, tmpworkdir):
+    mktree(
+        tmpworkdir,
+        {
+            'grablib.yml': """
+        build_root: "built_at"
+        cache: the_cache
+        build:
+          sass:
+            css:
+              src: sass_dir
+              incremental: true
+        """,
+            'sass_dir': {'aa.scss': 'a {color: white}'},
+        },
+    )
+    generate_css = mocker.spy(SassGenerator, 'generate_css')
+    Grab().build()
+    (manifest_file,) = tmpworkdir.join('the_cache/sass').listdir()
+    assert json.loads(manifest_file.read())['files'].keys() == {'aa.scss'}
+
+    manifest_file.write(manifest_file.read()[:20])
+    Grab().build()
+    assert generate_css.call_count == 2
+    assert json.loads(manifest_file.read())['files'].keys() == {'aa.scss'}
+
+    manifest = json.loads(manifest_file.read())
+    manifest['files']['aa.scss']['deps'] = ['wrong']
+    manifest_file.write(json.dumps(manifest))
+    Grab().build()
+    assert generate_css.call_count == 3
+    assert tmpworkdir.join('built_at/css/aa.css').read() == 'a{color:white}\n'
+
+
+def test_sass_incremental_import_changed_during_compile(mocker, tmpworkdir):
+    mktree(
+        tmpworkdir,
+        {
+            'grablib.yml': """
+        build_root: "built_at"
+        cache: the_cache
+        build:
+          sass:
+            css:
+              src: sass_dir
+              incremental: true
+        """,
+            'sass_dir': {'_mixin.scss': '$colour: red;', 'bb.scss': "@import 'mixin';\nb {color: $colour}"},
+        },
+    )
+    mixin_path = tmpworkdir.join('sass_dir/_mixin.scss')
+    real_read = ImportCache.read
+
+    def read_then_save(self, path):
+        r = real_read(self, path)
+        # the partial is saved after it's been read but before the compile finishes
+        mixin_path.write('$colour: blue;')
+        return r
+
+    mocker.patch.object(ImportCache, 'read', read_then_save)
+    generate_css = mocker.spy(SassGenerator, 'generate_css')
+    Grab().build()
+    assert tmpworkdir.join('built_at/css/bb.css').read() == 'b{color:red}\n'
+
+    mocker.patch.object(ImportCache, 'read', real_read)
+    Grab().build()
+    assert generate_css.call_count == 2
+    assert tmpworkdir.join('built_at/css/bb.css').read() == 'b{color:blue}\n'
+
+
+def test_cat_missing_source_atomic(tmpworkdir):
+    mktree(
+        tmpworkdir,
+        {
+            'grablib.yml': """
+        build_root: "built_at"
+        build:
+          cat:
+            "libraries.js":
+              - "./foo.js"
+              - "./missing.js"
+        """,
+            'foo.js': 'var v = "foo js";',
+            'built_at': {'libraries.js': 'previous'},
+        },
+    )
+    with pytest.raises(FileNotFoundError):
+        Grab().build()
+    assert gettree(tmpworkdir.join('built_at')) == {'libraries.js': 'previous'}
+
+
+def test_cat_jsmin_cache(mocker, tmpworkdir):
+    mktree(
+        tmpworkdir,
+        {
+            'grablib.yml': """
+        build_root: "built_at"
+        cache: the_cache
+        build:
+          cat:
+            "libraries.js":
+              - "./foo.js"
+              - src: "./bar.js"
+                replace:
+                  "bar": "BAR"
+              - "./x.min.js"
+        """,
+            'foo.js': 'var v = "foo js";',
+            'bar.js': 'var v = "bar js";',
+            'x.min.js': 'var x;',
+        },
+    )
+    read_bytes = mocker.spy(Path, 'read_bytes')
+    Grab().build()
+    assert read_bytes.call_count == 0
+    content = tmpworkdir.join('built_at/libraries.js').read()
+    assert content == (
+        '/* === foo.js === */\nvar v="foo js";\n/* === bar.js === */\nvar v="BAR js";\n/* === x.min.js === */\nvar x;\n'
+    )
+    assert len(tmpworkdir.join('the_cache/jsmin').listdir()) == 2
+
+    Grab().build()
+    assert read_bytes.call_count == 2
+    assert tmpworkdir.join('built_at/libraries.js').read() == content
+
+    tmpworkdir.join('foo.js').write('var v = "changed";')
+    Grab().build()
+    assert read_bytes.call_count == 3
+    assert len(tmpworkdir.join('the_cache/jsmin').listdir()) == 3
+
+
+def test_cat_workers(mocker, tmpworkdir):
+    mktree(
+        tmpworkdir,
+        {
+            'grablib.yml': """
+        build_root: "built_at"
+        cache: the_cache
+        build:
+          workers: 3
+          cat:
+            "a.js":
+              - "./foo.js"
+              - "./x.min.js"
+              - src: "./bar.js"
+                replace:
+                  "bar": "BAR"
+            "b.js":
+              - "./bar.js"
+              - "./foo.js"
+        """,
+            'foo.js': 'var v = "foo js";',
+            'bar.js': 'var v = "bar js";',
+            'x.min.js': 'var x;',
+        },
+    )
+    submit = mocker.spy(ProcessPoolExecutor, 'submit')
+    Grab().build()
+    assert gettree(tmpworkdir.join('built_at')) == {
+        'a.js': (
+            '/* === foo.js === */\nvar v="foo js";\n'
+            '/* === x.min.js === */\nvar x;\n'
+            '/* === bar.js === */\nvar v="BAR js";\n'
+        ),
+        'b.js': '/* === bar.js === */\nvar v="bar js";\n/* === foo.js === */\nvar v="foo js";\n',
+    }
+    assert len(tmpworkdir.join('the_cache/jsmin').listdir()) == 3
+    # only sources which need minifying are sent to workers
+    assert submit.call_count == 4
+
+    Grab().build()
+    assert submit.call_count == 4
+    assert tmpworkdir.join('built_at/a.js').read().startswith('/* === foo.js === */\nvar v="foo js";\n')
+
+
+def test_unchanged_outputs_not_rewritten(tmpworkdir):
+    mktree(
+        tmpworkdir,
+        {
+            'grablib.yml': """
+        build_root: "built_at"
+        build:
+          cat:
+            "a.js": ["./foo.js"]
+            "b.js": ["./bar.js"]
+          sass:
+            css: sass_dir
+        """,
+            'foo.js': 'var v = "foo js";',
+            'bar.js': 'var v = "bar js";',
+            'sass_dir': {'foo.scss': 'a {color: black}'},
+        },
+    )
+    Grab().build()
+    for path in ('a.js', 'b.js', 'css/foo.css'):
+        os.utime(str(tmpworkdir.join('built_at', path)), ns=(1, 1))
+
+    tmpworkdir.join('bar.js').write('var v = "changed";')
+    Grab().build()
+    assert os.stat(str(tmpworkdir.join('built_at/a.js'))).st_mtime_ns == 1
+    assert os.stat(str(tmpworkdir.join('built_at/b.js'))).st_mtime_ns != 1
+    assert os.stat(str(tmpworkdir.join('built_at/css/foo.css'))).st_mtime_ns == 1
+    assert gettree(tmpworkdir.join('built_at')) == {
+        'a.js': '/* === foo.js === */\nvar v="foo js";\n',
+        'b.js': '/* === bar.js === */\nvar v="changed";\n',
+        'css': {'foo.css': 'a{color:black}\n'},
+    }
+
+
+def test_write_if_changed(tmpdir):
+    path = Path(str(tmpdir.join('foo.txt')))
+    assert write_if_changed(path, 'hello') is True
+    assert write_if_changed(path, 'hello') is False
+    assert write_if_changed(path, b'hellO') is True
+    assert path.read_text() == 'hellO'
+    assert tmpdir.listdir() == [tmpdir.join('foo.txt')]
+
+
+def test_cat_source_maps(tmpworkdir):
+    mktree(
+        tmpworkdir,
+        {
+            'grablib.yml': """
+        build_root: "built_at"
+        debug: true
+        build:
+          source_maps: true
+          cat:
+            "js/libraries.js":
+              - "./src/foo.js"
+              - "./src/bar.js"
+            "styles.css":
+              - "./src/x.css"
+        """,
+            'src': {'foo.js': 'a\nb', 'bar.js': '\nc\n', 'x.css': 'x {}'},
+        },
+    )
+    Grab().build()
+    tree = gettree(tmpworkdir.join('built_at'))
+    assert tree['js']['libraries.js'] == (
+        '/* === foo.js === */\na\nb\n/* === bar.js === */\nc\n//# sourceMappingURL=libraries.js.map\n'
+    )
+    assert json.loads(tmpworkdir.join('built_at/js/libraries.js.map').read()) == {
+        'version': 3,
+        'file': 'libraries.js',
+        'sources': ['../../src/foo.js', '../../src/bar.js'],
+        'names': [],
+        'mappings': ';AAAA;AACA;;ACAA',
+    }
+    assert tree['styles.css'] == '/* === x.css === */\nx {}\n/*# sourceMappingURL=styles.css.map */\n'
+    assert json.loads(tmpworkdir.join('built_at/styles.css.map').read())['mappings'] == ';AAAA'
+
+
+def test_cat_source_maps_minified(tmpworkdir):
+    mktree(
+        tmpworkdir,
+        {
+            'grablib.yml': """
+        build_root: "built_at"
+        build:
+          source_maps: true
+          cat:
+            "libraries.js":
+              - "./foo.js"
+        """,
+            'foo.js': 'var v = "foo js";\nvar x = 1;',
+        },
+    )
+    Grab().build()
+    source_map = json.loads(tmpworkdir.join('built_at/libraries.js.map').read())
+    assert source_map['sources'] == ['../foo.js']
+    # jsmin has joined the lines
+    assert tmpworkdir.join('built_at/libraries.js').read().count('\n') == 3
+    assert source_map['mappings'] == ';AAAA'
+
+
+def test_apply_hash_manifest(tmpworkdir):
+    mktree(
+        tmpworkdir,
+        {
+            'grablib.yml': """
+        build_root: "built_at"
+        build:
+          apply_hash: true
+          cat:
+            "js/libraries.js":
+              - "./foo.js"
+          sass:
+            css: sass_dir
+            unhashed:
+              src: sass_dir
+              apply_hash: false
+        """,
+            'foo.js': 'var v = "foo js";',
+            'sass_dir': {'foo.scss': 'a {color: black}'},
+        },
+    )
+    Grab().build()
+    js_name = insert_hash(Path('libraries.js'), '/* === foo.js === */\nvar v="foo js";\n').name
+    css_name = insert_hash(Path('foo.css'), 'a{color:black}\n').name
+    tree = gettree(tmpworkdir.join('built_at'))
+    assert tree == {
+        'js': {js_name: '/* === foo.js === */\nvar v="foo js";\n'},
+        'css': {css_name: 'a{color:black}\n'},
+        'unhashed': {'foo.css': 'a{color:black}\n'},
+        'manifest.json': RegexStr('{.*'),
+    }
+    assert json.loads(tmpworkdir.join('built_at/manifest.json').read()) == {
+        'css/foo.css': 'css/' + css_name,
+        'js/libraries.js': 'js/' + js_name,
+    }
+
+
+def test_compress(tmpworkdir):
+    mktree(
+        tmpworkdir,
+        {
+            'grablib.yml': """
+        build_root: "built_at"
+        build:
+          compress: gzip
+          cat:
+            "libraries.js":
+              - "./foo.js"
+          sass:
+            css: sass_dir
+        """,
+            'foo.js': 'var v = "foo js";',
+            'sass_dir': {'foo.scss': 'a {color: black}'},
+        },
+    )
+    Grab().build()
+    built = tmpworkdir.join('built_at')
+    assert sorted(p.relto(built) for p in built.visit()) == [
+        'css',
+        'css/foo.css',
+        'css/foo.css.gz',
+        'libraries.js',
+        'libraries.js.gz',
+    ]
+    assert gzip.decompress(built.join('css/foo.css.gz').read_binary()) == b'a{color:black}\n'
+    assert gzip.decompress(built.join('libraries.js.gz').read_binary()) == built.join('libraries.js').read_binary()
+
+    gz_mtime = os.stat(str(built.join('css/foo.css.gz'))).st_mtime_ns
+    Grab().build()
+    assert os.stat(str(built.join('css/foo.css.gz'))).st_mtime_ns == gz_mtime
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_rm_pruned(mocker, tmpworkdir, workers):
+    mktree(
+        tmpworkdir,
+        {
+            'grablib.yml': f"""
+        build_root: "built_at"
+        build:
+          workers: {workers}
+          wipe:
+          - another_dir.*
+          - (foo|bar)/x.txt
+        """,
+            'built_at': {
+                'foo': {'x.txt': 'x', 'y.txt': 'y'},
+                'another_dir': {'a.txt': 'x', 'sub': {'b.txt': 'x'}},
+                'remain.txt': 'y',
+            },
+        },
+    )
+    scandir = mocker.spy(os, 'scandir')
+    info = mocker.spy(main_logger, 'info')
+    Grab().build()
+    assert {'foo': {'y.txt': 'y'}, 'remain.txt': 'y'} == gettree(tmpworkdir.join('built_at'))
+    assert info.call_args_list[0] == mocker.call('%d paths deleted', 2)
+    # another_dir matched so it's deleted without being searched
+    scanned = sorted(Path(c[0][0]).name for c in scandir.call_args_list if isinstance(c[0][0], str))
+    assert scanned == ['built_at', 'foo']
+
+
+def test_sass_exclude_prunes_directories(mocker, tmpworkdir):
+    mktree(
+        tmpworkdir,
+        {
+            'grablib.yml': """
+        build_root: "built_at"
+        build:
+          sass:
+            css:
+              src: sass_dir
+              exclude: 'node_modules/'
+        """,
+            'sass_dir': {
+                'node_modules': {'pkg': {'lib.scss': 'a {color: red}'}},
+                'adir': {'bb.scss': 'b {color: white}'},
+                'aa.scss': 'a {color: black}',
+            },
+        },
+    )
+    scandir = mocker.spy(os, 'scandir')
+    Grab().build()
+    assert gettree(tmpworkdir.join('built_at')) == {
+        'css': {'aa.css': 'a{color:black}\n', 'adir': {'bb.css': 'b{color:white}\n'}}
+    }
+    assert sorted(Path(c[0][0]).name for c in scandir.call_args_list) == ['adir', 'sass_dir']
+
+
+def test_sass_imports_read_once(mocker, tmpworkdir):
+    mktree(
+        tmpworkdir,
+        {
+            'grablib.yml': """
+        build_root: "built_at"
+        build:
+          sass:
+            css: sass_dir
+        """,
+            'sass_dir': {
+                '_mixin.scss': '$colour: red;',
+                'aa.scss': "@import 'mixin';\na {color: $colour}",
+                'bb.scss': "@import 'mixin';\nb {color: $colour}",
+                'cc.scss': "@import 'SRC/mixin';\nc {color: $colour}",
+            },
+        },
+    )
+    resolve = mocker.spy(SassGenerator, '_resolve_import')
+    read_bytes = mocker.spy(Path, 'read_bytes')
+    Grab().build()
+    assert gettree(tmpworkdir.join('built_at')) == {
+        'css': {'aa.css': 'a{color:red}\n', 'bb.css': 'b{color:red}\n', 'cc.css': 'c{color:red}\n'}
+    }
+    assert [c[0][1] for c in resolve.call_args_list] == ['mixin', 'SRC/mixin']
+    assert [c[0][0].name for c in read_bytes.call_args_list if c[0][0].name == '_mixin.scss'] == ['_mixin.scss']
+
+
+def test_import_cache(tmpdir):
+    path = Path(str(tmpdir.join('_foo.scss')))
+    path.write_text('a {}')
+    import_cache = ImportCache()
+    stat = path.stat()
+    assert import_cache.read(path) == ('a {}', [stat.st_mtime_ns, 4, hashlib.md5(b'a {}').hexdigest()])
+    path.write_text('changed')
+    assert import_cache.read(path)[0] == 'changed'
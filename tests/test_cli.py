@@ -1,16 +1,19 @@
 from click.testing import CliRunner
 from pytest_toolbox import gettree, mktree
 
+from grablib import download
 from grablib.cli import cli
 from grablib.common import log_config
 
+from .test_download import MockResponse
+
 
 def test_simple_wrong_path():
     runner = CliRunner()
     result = runner.invoke(cli, ['download', '-f', 'test_file'])
     assert result.exit_code == 2
     assert result.output == (
-        'Usage: cli [OPTIONS] [download / build]\n'
+        'Usage: cli [OPTIONS] [download / build / watch]\n'
         "Try 'cli --help' for help.\n"
         '\n'
         "Error: Invalid value for '-f' / '--config-file': File 'test_file' does not exist.\n"
@@ -80,3 +83,49 @@ def test_log_setup():
     assert log_config('INFO')['handlers']['default']['level'] == 'INFO'
     assert log_config(3)['handlers']['default']['level'] == 'DEBUG'
     assert log_config('DEBUG')['handlers']['default']['level'] == 'DEBUG'
+
+
+def test_download_jobs(mocker, tmpworkdir):
+    mktree(
+        tmpworkdir,
+        {
+            'grablib.yml': """\
+        download_root: static
+        download:
+          "http://wherever.com/a.js": a.js
+          "http://wherever.com/b.js": b.js
+        """
+        },
+    )
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.return_value = MockResponse()
+    mock_executor = mocker.spy(download, 'ThreadPoolExecutor')
+    result = CliRunner().invoke(cli, ['download', '-j', '3'])
+    assert result.exit_code == 0, result.output
+    mock_executor.assert_called_once_with(max_workers=3)
+    assert gettree(tmpworkdir.join('static')) == {'a.js': 'response text', 'b.js': 'response text'}
+
+
+def test_download_paranoid(mocker, tmpworkdir):
+    mktree(tmpworkdir, {'grablib.yml': 'download_root: static\ndownload: {}'})
+    mock_downloader = mocker.patch('grablib.grab.Downloader')
+    result = CliRunner().invoke(cli, ['download', '--paranoid'])
+    assert result.exit_code == 0, result.output
+    mock_downloader.assert_called_once_with(download_root='static', download={}, paranoid=True)
+
+
+def test_watch(mocker, tmpworkdir):
+    mktree(tmpworkdir, {'grablib.yml': 'build_root: built_at\nbuild:\n  cat:\n    "x.js": ["./foo.js"]', 'foo.js': 'x'})
+    run = mocker.patch('grablib.grab.Watcher.run', side_effect=KeyboardInterrupt)
+    result = CliRunner().invoke(cli, ['watch'])
+    assert result.exit_code == 0, result.output
+    assert run.call_count == 1
+
+
+def test_download_interrupted(mocker, tmpworkdir):
+    mktree(tmpworkdir, {'grablib.yml': "download_root: droot\ndownload:\n  'http://wherever.com/file.js': x"})
+    mocker.patch('grablib.grab.Downloader.__call__', side_effect=KeyboardInterrupt)
+    result = CliRunner().invoke(cli, ['download'])
+    # click reports the interrupt as "Aborted!" and exits with 1
+    assert result.exit_code == 1
+    assert 'Aborted!' in result.output
@@ -0,0 +1,43 @@
+import builtins
+import gzip
+import os
+from pathlib import Path
+
+import pytest
+
+from grablib.common import GrablibError
+from grablib.compress import compress_file, compress_formats
+
+real_import = builtins.__import__
+
+
+def mocked_import(name, globals=None, locals=None, fromlist=(), level=0):
+    if name == 'brotli':
+        raise ImportError('fake error for %s' % name)
+    return real_import(name, globals, locals, fromlist, level)
+
+
+def test_compress_formats(mocker):
+    mocker.patch('builtins.__import__', side_effect=mocked_import)
+    assert compress_formats(True) == ['gzip']
+    assert compress_formats(False) == []
+    assert compress_formats('gzip') == ['gzip']
+    with pytest.raises(GrablibError) as exc_info:
+        compress_formats(['gzip', 'brotli'])
+    assert exc_info.value.args[0] == 'Error importing brotli, run `pip install brotli` to use brotli compression'
+    with pytest.raises(GrablibError) as exc_info:
+        compress_formats(['zip'])
+    assert exc_info.value.args[0] == 'unknown compression format "zip", options are: gzip, brotli'
+
+
+def test_compress_file(tmpdir):
+    path = Path(str(tmpdir.join('foo.js')))
+    path.write_text('var x = 1;' * 100)
+    assert compress_file(path, ['gzip']) == 1
+    gz_path = Path(str(tmpdir.join('foo.js.gz')))
+    assert gzip.decompress(gz_path.read_bytes()).decode() == 'var x = 1;' * 100
+    assert compress_file(path, ['gzip']) == 0
+
+    os.utime(str(gz_path), ns=(1, 1))
+    assert compress_file(path, ['gzip']) == 1
+    assert sorted(p.name for p in path.parent.iterdir()) == ['foo.js', 'foo.js.gz']
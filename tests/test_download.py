@@ -1,11 +1,21 @@
+import hashlib
+import json
+import os
+import zipfile
 from pathlib import Path
+from unittest.mock import call
 
 import pytest
 from pytest_toolbox import gettree, mktree
+from pytest_toolbox.comparison import RegexStr
 from requests import HTTPError
+from requests.exceptions import ChunkedEncodingError
 
+import grablib.download
 from grablib import Grab
+from grablib.cache import FileCache, cache_root
 from grablib.common import GrablibError
+from grablib.download import Downloader, ZipLookup, literal_prefix
 
 FIXTURES = Path(__file__).resolve().parent / Path('fixtures')
 
@@ -16,6 +26,16 @@ class MockResponse:
         self.content = content
         self.headers = headers or {'content-type': 'application/json', 'server': 'Mock'}
 
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i : i + chunk_size]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
 
 def request_fixture(url, **kwargs):
     filename = url.split('/')[-1]
@@ -33,6 +53,7 @@ def test_simple(mocker, tmpworkdir):
     assert gettree(tmpworkdir) == {
         'grablib.yml': "download:\n  'http://wherever.com/file.js': x",
         'test-download-dir': {'x': 'response text'},
+        '.grablib.lock.stat': RegexStr('{.*'),
         '.grablib.lock': 'b5a3344a4b3651ebd60a1e15309d737c http://wherever.com/file.js x\n',
     }
 
@@ -139,7 +160,7 @@ def test_with_aliases(mocker, tmpworkdir):
     mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
     mock_requests_get.return_value = MockResponse()
     Grab().download()
-    mock_requests_get.assert_called_with('https://www.whatever.com/foo.js')
+    mock_requests_get.assert_called_with('https://www.whatever.com/foo.js', stream=True, headers={}, timeout=(10, 60))
     assert gettree(tmpworkdir.join('download_to')) == {'js': {'foo.js': 'response text'}}
 
 
@@ -213,6 +234,7 @@ def test_simple_lock(mocker, tmpworkdir):
     assert gettree(tmpworkdir) == {
         'grablib.yml': "lock: the.lock\ndownload:\n  'http://wherever.com/file.js': x",
         'static': {'x': 'response text'},
+        'the.lock.stat': RegexStr('{.*'),
         'the.lock': 'b5a3344a4b3651ebd60a1e15309d737c http://wherever.com/file.js x\n',
     }
     Grab(download_root='static').download()
@@ -233,6 +255,7 @@ def test_lock_one_change(mocker, tmpworkdir):
     assert gettree(tmpworkdir, max_len=None) == {
         'grablib.yml': yml,
         'droot': {'file.js': 'response text', 'file2.js': 'response text'},
+        '.grablib.lock.stat': RegexStr('{.*'),
         '.grablib.lock': """\
 b5a3344a4b3651ebd60a1e15309d737c http://wherever.com/file.js file.js
 b5a3344a4b3651ebd60a1e15309d737c http://wherever.com/file2.js file2.js\n""",
@@ -244,6 +267,7 @@ b5a3344a4b3651ebd60a1e15309d737c http://wherever.com/file2.js file2.js\n""",
     assert gettree(tmpworkdir, max_len=None) == {
         'grablib.yml': yml,
         'droot': {'file.js': 'response text', 'file2.js': 'response text'},
+        '.grablib.lock.stat': RegexStr('{.*'),
         '.grablib.lock': """\
 b5a3344a4b3651ebd60a1e15309d737c http://wherever.com/file.js file.js
 b5a3344a4b3651ebd60a1e15309d737c http://wherever.com/file2.js file2.js\n""",
@@ -259,6 +283,7 @@ def test_lock_local_file_changes(mocker, tmpworkdir):
     assert gettree(tmpworkdir) == {
         'grablib.yml': "download:\n  'http://wherever.com/file.js': x",
         'test-download-dir': {'x': 'response text'},
+        '.grablib.lock.stat': RegexStr('{.*'),
         '.grablib.lock': 'b5a3344a4b3651ebd60a1e15309d737c http://wherever.com/file.js x\n',
     }
     mktree(tmpworkdir, {'grablib.yml': "download:\n  'http://wherever.com/file.js': x2"})
@@ -267,6 +292,7 @@ def test_lock_local_file_changes(mocker, tmpworkdir):
     assert gettree(tmpworkdir, max_len=0) == {
         'grablib.yml': "download:\n  'http://wherever.com/file.js': x2",
         'test-download-dir': {'x2': 'response text'},
+        '.grablib.lock.stat': RegexStr('{.*'),
         '.grablib.lock': 'b5a3344a4b3651ebd60a1e15309d737c http://wherever.com/file.js x2\n'
         '# "stale" files which grablib should delete where found, '
         'you can delete these once everyone has run grablib\n'
@@ -283,6 +309,7 @@ def test_lock_remote_file_changes(mocker, tmpworkdir):
     assert gettree(tmpworkdir) == {
         'grablib.yml': "download:\n  'http://wherever.com/file.js': x",
         's': {'x': 'response text'},
+        '.grablib.lock.stat': RegexStr('{.*'),
         '.grablib.lock': 'b5a3344a4b3651ebd60a1e15309d737c http://wherever.com/file.js x\n',
     }
     tmpworkdir.join('s/x').remove()
@@ -298,6 +325,7 @@ download:
 zip_downloaded_directory = {
     'grablib.yml': zip_dowload_yml,
     'droot': {'subdirectory': {'b.txt': 'b\n', 'a.txt': 'a\n'}},
+    '.grablib.lock.stat': RegexStr('{.*'),
     '.grablib.lock': """\
 b56e6adc64a2a57319285ae64e64d2ec https://any-old-url.com/test_assets.zip :zip-lookup
 0d815adb49aeaa79990afa6387b36014 https://any-old-url.com/test_assets.zip :zip-raw
@@ -359,6 +387,7 @@ def test_lock_unchanged(mocker, tmpworkdir):
     assert gettree(tmpworkdir) == {
         'grablib.yml': "download:\n  'http://wherever.com/file.js': x",
         'test-download-dir': {'x': 'response text'},
+        '.grablib.lock.stat': RegexStr('{.*'),
         '.grablib.lock': 'b5a3344a4b3651ebd60a1e15309d737c http://wherever.com/file.js x\n',
     }
 
@@ -380,6 +409,7 @@ def test_lock_extended(mocker, tmpworkdir):
     assert gettree(tmpworkdir, max_len=0) == {
         'grablib.yml': gl,
         'test-download-dir': {'x': 'response text', 'y': 'response text'},
+        '.grablib.lock.stat': RegexStr('{.*'),
         '.grablib.lock': 'b5a3344a4b3651ebd60a1e15309d737c http://wherever.com/file1.js x\n'
         'b5a3344a4b3651ebd60a1e15309d737c http://wherever.com/file2.js y\n',
     }
@@ -406,6 +436,7 @@ def test_lock_file_removed(mocker, tmpworkdir):
     assert gettree(tmpworkdir, max_len=0) == {
         'grablib.yml': gl,
         'test-download-dir': {'x': 'response text'},
+        '.grablib.lock.stat': RegexStr('{.*'),
         '.grablib.lock': 'b5a3344a4b3651ebd60a1e15309d737c http://wherever.com/file1.js x\n'
         '# "stale" files which grablib should delete where found, '
         'you can delete these once everyone has run grablib\n'
@@ -433,6 +464,7 @@ def test_changed_file_url(mocker, tmpworkdir):
     assert gettree(tmpworkdir, max_len=0) == {
         'grablib.yml': gl,
         'test-download-dir': {'x': 'response text'},
+        '.grablib.lock.stat': RegexStr('{.*'),
         '.grablib.lock': 'b5a3344a4b3651ebd60a1e15309d737c http://wherever.com/file_different.js x\n',
     }
 
@@ -458,6 +490,8 @@ def test_stale_changed(mocker, tmpworkdir):
     assert gettree(tmpworkdir) == {
         'grablib.yml': gl,
         '.grablib.lock': 'b5a3344a4b3651ebd60a1e15309d737c http://wherever.com/file.js old\n',
+        # the run failed so the journal is kept for the next run to resume from
+        '.grablib.lock.journal': 'b5a3344a4b3651ebd60a1e15309d737c http://wherever.com/file.js x\n',
         'test-download-dir': {'old': 'response text - different', 'x': 'response text'},
     }
 
@@ -531,9 +565,664 @@ def test_stale_lock(mocker, tmpworkdir):
     grab.download()
     assert gettree(tmpworkdir, max_len=0) == {
         'grablib.yml': gl,
+        '.grablib.lock.stat': RegexStr('{.*'),
         '.grablib.lock': 'b5a3344a4b3651ebd60a1e15309d737c http://wherever.com/file.js foo\n'
         '# "stale" files which grablib should delete where found, '
         'you can delete these once everyone has run grablib\n'
         'b5a3344a4b3651ebd60a1e15309d737c :stale to_delete\n',
         'test-download-dir': {'foo': 'response text'},
     }
+
+
+def test_concurrency(mocker, tmpworkdir):
+    yml = 'download_root: droot\nconcurrency: 4\ndownload:\n' + ''.join(
+        "  'http://wherever.com/file{0}.js': file{0}.js\n".format(i) for i in range(10)
+    )
+    mktree(tmpworkdir, {'grablib.yml': yml})
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.return_value = MockResponse()
+    Grab().download()
+    assert mock_requests_get.call_count == 10
+    assert gettree(tmpworkdir.join('droot')) == {'file{}.js'.format(i): 'response text' for i in range(10)}
+    assert tmpworkdir.join('.grablib.lock').read() == ''.join(
+        'b5a3344a4b3651ebd60a1e15309d737c http://wherever.com/file{0}.js file{0}.js\n'.format(i) for i in range(10)
+    )
+    Grab().download()
+    assert mock_requests_get.call_count == 10
+
+
+def test_concurrency_error(mocker, tmpworkdir):
+    mktree(
+        tmpworkdir,
+        {
+            'grablib.yml': """\
+        download_root: download_to
+        download:
+          "https://www.whatever.com/foo.js": "js/"
+          "https://www.whatever.com/bar.js": "js/"
+        """
+        },
+    )
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.return_value = MockResponse(status_code=403)
+    with pytest.raises(GrablibError) as excinfo:
+        Grab(concurrency=2).download()
+    assert excinfo.value.args == ('Error downloading "https://www.whatever.com/foo.js" to "js/"',)
+    assert tmpworkdir.join('.grablib.lock').check() is False
+
+
+def test_streamed_download(mocker, tmpworkdir):
+    content = b'x' * 100_000 + b'y' * 100_000
+    mktree(tmpworkdir, {'grablib.yml': "download:\n  'http://wherever.com/big.bin': big.bin"})
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.return_value = MockResponse(content=content)
+    Grab(download_root='droot').download()
+    assert tmpworkdir.join('droot').listdir() == [tmpworkdir.join('droot/big.bin')]
+    assert tmpworkdir.join('droot/big.bin').read_binary() == content
+    assert tmpworkdir.join('.grablib.lock').read() == '{} http://wherever.com/big.bin big.bin\n'.format(
+        hashlib.md5(content).hexdigest()
+    )
+
+
+def test_streamed_download_error(mocker, tmpworkdir):
+    mktree(tmpworkdir, {'grablib.yml': "download:\n  'http://wherever.com/file.js': x"})
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    response = MockResponse()
+    mocker.patch.object(response, 'iter_content', side_effect=ChunkedEncodingError('connection reset'))
+    mock_requests_get.return_value = response
+    sleep = mocker.patch('grablib.download.time.sleep')
+    with pytest.raises(GrablibError):
+        Grab(download_root='droot').download()
+    assert tmpworkdir.join('droot').listdir() == []
+    assert mock_requests_get.call_count == 3
+    assert sleep.call_args_list == [call(0.5), call(1.0)]
+
+
+def test_lock_validators(mocker, tmpworkdir):
+    mktree(tmpworkdir, {'grablib.yml': "download:\n  'http://wherever.com/file.js': x"})
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.side_effect = [
+        MockResponse(headers={'ETag': '"abc"', 'Last-Modified': 'Wed, 21 Oct 2015 07:28:00 GMT'}),
+        MockResponse(status_code=304),
+    ]
+    Grab(download_root='droot').download()
+    lock = (
+        '"abc" http://wherever.com/file.js :etag\n'
+        'Wed,%2021%20Oct%202015%2007:28:00%20GMT http://wherever.com/file.js :last-modified\n'
+        'b5a3344a4b3651ebd60a1e15309d737c http://wherever.com/file.js x\n'
+    )
+    assert tmpworkdir.join('.grablib.lock').read() == lock
+    Grab(download_root='droot').download()
+    assert mock_requests_get.call_count == 1
+    assert tmpworkdir.join('.grablib.lock').read() == lock
+
+    mktree(tmpworkdir, {'grablib.yml': "download:\n  'http://wherever.com/file.js': y"})
+    Grab(download_root='droot').download()
+    assert mock_requests_get.call_count == 2
+    mock_requests_get.assert_called_with(
+        'http://wherever.com/file.js',
+        stream=True,
+        headers={'If-None-Match': '"abc"', 'If-Modified-Since': 'Wed, 21 Oct 2015 07:28:00 GMT'},
+        timeout=(10, 60),
+    )
+    assert gettree(tmpworkdir.join('droot')) == {'y': 'response text'}
+    assert tmpworkdir.join('.grablib.lock').read() == lock.replace('file.js x', 'file.js y') + (
+        '# "stale" files which grablib should delete where found, you can delete these once everyone has run grablib\n'
+        'b5a3344a4b3651ebd60a1e15309d737c :stale x\n'
+    )
+
+
+def test_lock_validators_missing_file(mocker, tmpworkdir):
+    mktree(
+        tmpworkdir,
+        {
+            'grablib.yml': "download:\n  'http://wherever.com/file.js': x",
+            '.grablib.lock': '"abc" http://wherever.com/file.js :etag\n'
+            'b5a3344a4b3651ebd60a1e15309d737c http://wherever.com/file.js x\n',
+        },
+    )
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.return_value = MockResponse(headers={'ETag': '"abc"'})
+    Grab(download_root='droot').download()
+    # no local copy to restore from so the request must not be conditional
+    mock_requests_get.assert_called_once_with('http://wherever.com/file.js', stream=True, headers={}, timeout=(10, 60))
+    assert gettree(tmpworkdir.join('droot')) == {'x': 'response text'}
+
+
+def test_cache(mocker, tmpworkdir):
+    mktree(tmpworkdir, {'grablib.yml': "cache: the-cache\ndownload:\n  'http://wherever.com/file.js': x"})
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.return_value = MockResponse()
+    Grab(download_root='droot').download()
+    assert mock_requests_get.call_count == 1
+    assert gettree(tmpworkdir.join('the-cache')) == {'downloads': {'b5a3344a4b3651ebd60a1e15309d737c': 'response text'}}
+
+    tmpworkdir.join('droot/x').remove()
+    Grab(download_root='droot').download()
+    assert mock_requests_get.call_count == 1
+    assert gettree(tmpworkdir.join('droot')) == {'x': 'response text'}
+    assert tmpworkdir.join('.grablib.lock').read() == 'b5a3344a4b3651ebd60a1e15309d737c http://wherever.com/file.js x\n'
+
+
+def test_cache_corrupt(mocker, tmpworkdir):
+    mktree(
+        tmpworkdir,
+        {
+            'grablib.yml': "cache: the-cache\ndownload:\n  'http://wherever.com/file.js': x",
+            '.grablib.lock': 'b5a3344a4b3651ebd60a1e15309d737c http://wherever.com/file.js x\n',
+            'the-cache/downloads/b5a3344a4b3651ebd60a1e15309d737c': 'corrupted',
+        },
+    )
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.return_value = MockResponse()
+    Grab(download_root='droot').download()
+    assert mock_requests_get.call_count == 1
+    assert gettree(tmpworkdir.join('droot')) == {'x': 'response text'}
+    assert gettree(tmpworkdir.join('the-cache')) == {'downloads': {'b5a3344a4b3651ebd60a1e15309d737c': 'response text'}}
+
+
+def test_cache_zip(mocker, tmpworkdir):
+    mktree(tmpworkdir, {'grablib.yml': 'cache: the-cache\n' + zip_dowload_yml})
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.side_effect = request_fixture
+    Grab().download()
+    assert mock_requests_get.call_count == 1
+    assert tmpworkdir.join('the-cache/downloads/0d815adb49aeaa79990afa6387b36014').check()
+
+    tmpworkdir.join('droot').remove()
+    Grab().download()
+    assert mock_requests_get.call_count == 1
+    assert gettree(tmpworkdir.join('droot')) == zip_downloaded_directory['droot']
+    assert tmpworkdir.join('.grablib.lock').read() == zip_downloaded_directory['.grablib.lock']
+
+
+def test_cache_evict(tmpdir):
+    cache = FileCache(Path(tmpdir), max_size=10)
+    mktree(tmpdir, {'a': '1234', 'b': '1234', 'c': '1234'})
+    for i, name in enumerate('bca'):
+        os.utime(str(tmpdir.join(name)), (i, i))
+    assert cache.get('a') == Path(tmpdir.join('a'))
+    assert cache.get('missing') is None
+    assert cache.evict() == 1
+    assert gettree(tmpdir) == {'a': '1234', 'c': '1234'}
+
+
+def test_cache_root(monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', '/path/to/cache')
+    assert cache_root(True) == Path('/path/to/cache/grablib')
+    assert cache_root('~/foobar') == Path.home() / 'foobar'
+
+
+def test_stat_cache(mocker, tmpworkdir):
+    mktree(tmpworkdir, {'grablib.yml': "download:\n  'http://wherever.com/file.js': x"})
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.return_value = MockResponse()
+    Grab(download_root='droot').download()
+    assert mock_requests_get.call_count == 1
+
+    file_hash = mocker.spy(grablib.download, 'file_hash')
+    Grab(download_root='droot').download()
+    assert mock_requests_get.call_count == 1
+    assert file_hash.call_count == 0
+
+    Grab(download_root='droot', paranoid=True).download()
+    assert mock_requests_get.call_count == 1
+    assert file_hash.call_count == 1
+
+    tmpworkdir.join('droot/x').write('changed')
+    Grab(download_root='droot').download()
+    assert mock_requests_get.call_count == 2
+    assert gettree(tmpworkdir.join('droot')) == {'x': 'response text'}
+
+
+@pytest.mark.parametrize(
+    'stat_cache',
+    ['not json', '[1, 2]', '{"download_root": "/other", "files": {}}', '{"download_root": "%s", "files": {"x": 1}}'],
+)
+def test_stat_cache_invalid(mocker, tmpworkdir, stat_cache):
+    mktree(tmpworkdir, {'grablib.yml': "download:\n  'http://wherever.com/file.js': x"})
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.return_value = MockResponse()
+    Grab(download_root='droot').download()
+    if '%s' in stat_cache:
+        stat_cache %= tmpworkdir.join('droot')
+    tmpworkdir.join('.grablib.lock.stat').write(stat_cache)
+
+    file_hash = mocker.spy(grablib.download, 'file_hash')
+    Grab(download_root='droot').download()
+    assert mock_requests_get.call_count == 1
+    assert file_hash.call_count == 1
+    assert json.loads(tmpworkdir.join('.grablib.lock.stat').read())['files'].keys() == {'x'}
+
+
+def test_stat_cache_unwritable(mocker, tmpworkdir):
+    mktree(tmpworkdir, {'grablib.yml': "download:\n  'http://wherever.com/file.js': x", '.grablib.lock.stat': {}})
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.return_value = MockResponse()
+    Grab(download_root='droot').download()
+    assert tmpworkdir.join('droot/x').read() == 'response text'
+    assert tmpworkdir.join('.grablib.lock').check()
+
+
+def test_stat_cache_no_lock(mocker, tmpworkdir):
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.return_value = MockResponse()
+    Downloader(download_root='droot', download={'http://wherever.com/file.js': 'x'}, lock=None)()
+    assert gettree(tmpworkdir) == {'droot': {'x': 'response text'}}
+
+
+def test_stat_cache_zip(mocker, tmpworkdir):
+    mktree(tmpworkdir, {'grablib.yml': zip_dowload_yml})
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.side_effect = request_fixture
+    Grab().download()
+    read_bytes = mocker.spy(Path, 'read_bytes')
+    Grab().download()
+    assert read_bytes.call_count == 0
+    assert mock_requests_get.call_count == 1
+    assert zip_downloaded_directory == gettree(tmpworkdir, max_len=None)
+
+
+def test_zip_double_read_once(mocker, tmpworkdir):
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.side_effect = request_fixture
+    mktree(
+        tmpworkdir,
+        {
+            'grablib.yaml': """
+      'download':
+        'https://any-old-url.com/test_assets.zip':
+           'test_assets/assets/a.txt':
+             - a.txt
+             - x/a_again.txt
+    """
+        },
+    )
+    zip_open = mocker.spy(zipfile.ZipFile, 'open')
+    Grab(download_root='droot').download()
+    assert zip_open.call_count == 1
+    assert gettree(tmpworkdir.join('droot')) == {'a.txt': 'a\n', 'x': {'a_again.txt': 'a\n'}}
+    assert tmpworkdir.join('.grablib.lock').read() == (
+        '6b35155ab4a4db8cd3269069494bfd6d https://any-old-url.com/test_assets.zip :zip-lookup\n'
+        '0d815adb49aeaa79990afa6387b36014 https://any-old-url.com/test_assets.zip :zip-raw\n'
+        '60b725f10c9c85c70d97880dfe8191b3 https://any-old-url.com/test_assets.zip a.txt\n'
+        '60b725f10c9c85c70d97880dfe8191b3 https://any-old-url.com/test_assets.zip x/a_again.txt\n'
+    )
+
+
+@pytest.mark.parametrize(
+    'pattern,prefix',
+    [
+        ('test_assets/assets/(.+)', 'test_assets/assets/'),
+        ('^bootstrap-3.3.6/dist/(.+)$', 'bootstrap-3'),
+        (r'bootstrap-3\.3\.6/dist/(.+)$', 'bootstrap-3.3.6/dist/'),
+        ('fonts?/(.+)', 'font'),
+        ('abc+d', 'abc'),
+        ('ab{2}', 'a'),
+        (r'a\d', 'a'),
+        ('a|b', ''),
+        ('(?i)abc', ''),
+        ('.*', ''),
+    ],
+)
+def test_literal_prefix(pattern, prefix):
+    assert literal_prefix(pattern) == prefix
+
+
+def test_zip_lookup():
+    zip_lookup = ZipLookup({'a/b/c.txt': None, 'a/b/(.+)': 'b/', r'.*\.js': 'js/'})
+    assert zip_lookup.match('x/y.txt') is None
+    assert zip_lookup.match('a/b/c.txt')[:2] == ('a/b/c.txt', None)
+    pattern, targets, m = zip_lookup.match('a/b/d.txt')
+    assert (pattern, targets, m.groups()) == ('a/b/(.+)', 'b/', ('d.txt',))
+    assert zip_lookup.match('x/y.js')[:2] == (r'.*\.js', 'js/')
+
+
+def test_journal_resume(mocker, tmpworkdir):
+    mktree(
+        tmpworkdir,
+        {'grablib.yml': "download:\n  'http://wherever.com/a.js': a.js\n  'http://wherever.com/b.js': b.js"},
+    )
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.side_effect = [MockResponse(), MockResponse(status_code=404)]
+    with pytest.raises(GrablibError):
+        Grab(download_root='droot').download()
+    assert tmpworkdir.join('.grablib.lock').check() is False
+    assert tmpworkdir.join('.grablib.lock.journal').read() == (
+        'b5a3344a4b3651ebd60a1e15309d737c http://wherever.com/a.js a.js\n'
+    )
+
+    mock_requests_get.side_effect = None
+    mock_requests_get.return_value = MockResponse()
+    Grab(download_root='droot').download()
+    assert [c[0][0] for c in mock_requests_get.call_args_list[2:]] == ['http://wherever.com/b.js']
+    assert gettree(tmpworkdir, max_len=0) == {
+        'grablib.yml': RegexStr('download.*'),
+        '.grablib.lock.stat': RegexStr('{.*'),
+        '.grablib.lock': (
+            'b5a3344a4b3651ebd60a1e15309d737c http://wherever.com/a.js a.js\n'
+            'b5a3344a4b3651ebd60a1e15309d737c http://wherever.com/b.js b.js\n'
+        ),
+        'droot': {'a.js': 'response text', 'b.js': 'response text'},
+    }
+
+
+def test_journal_read(tmpworkdir):
+    mktree(
+        tmpworkdir,
+        {
+            '.grablib.lock': 'aaa http://x.com/a.js a.js\nbbb http://x.com/b.js b.js\n',
+            '.grablib.lock.journal': (
+                'ccc http://x.com/a.js a2.js\n'
+                'ddd http://x.com/c.js c.js\n'
+                'eee http://x.com/a.js a3.js\n'
+                'fff http://x.com/d.'
+            ),
+        },
+    )
+    downloader = Downloader(download_root='droot', download={})
+    current_lock, stale_files, validators = downloader._read_lock()
+    assert current_lock == {
+        'http://x.com/a.js': ('a3.js', 'eee'),
+        'http://x.com/b.js': ('b.js', 'bbb'),
+        'http://x.com/c.js': ('c.js', 'ddd'),
+    }
+    assert stale_files == {'a.js': 'aaa', 'a2.js': 'ccc', 'a3.js': 'eee', 'b.js': 'bbb', 'c.js': 'ddd'}
+
+
+def part_name(url):
+    return '.grablib-{}.part'.format(hashlib.md5(url.encode()).hexdigest())
+
+
+def test_resume_part(mocker, tmpworkdir):
+    url = 'http://wherever.com/file.js'
+    mktree(
+        tmpworkdir,
+        {
+            'grablib.yml': "download:\n  '{}': x".format(url),
+            '.grablib.lock': 'b5a3344a4b3651ebd60a1e15309d737c {} x\n'.format(url),
+            'droot': {part_name(url): 'response'},
+        },
+    )
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.return_value = MockResponse(
+        status_code=206, content=b' text', headers={'Content-Range': 'bytes 8-12/13'}
+    )
+    Grab(download_root='droot').download()
+    mock_requests_get.assert_called_with(url, stream=True, headers={'Range': 'bytes=8-'}, timeout=(10, 60))
+    assert gettree(tmpworkdir.join('droot')) == {'x': 'response text'}
+
+
+def test_resume_part_range_ignored(mocker, tmpworkdir):
+    url = 'http://wherever.com/file.js'
+    mktree(
+        tmpworkdir,
+        {
+            'grablib.yml': "download:\n  '{}': x".format(url),
+            '.grablib.lock': 'b5a3344a4b3651ebd60a1e15309d737c {} x\n'.format(url),
+            'droot': {part_name(url): 'response'},
+        },
+    )
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.return_value = MockResponse()
+    Grab(download_root='droot').download()
+    assert mock_requests_get.call_count == 1
+    assert gettree(tmpworkdir.join('droot')) == {'x': 'response text'}
+
+
+def test_resume_part_mismatch(mocker, tmpworkdir):
+    url = 'http://wherever.com/file.js'
+    mktree(
+        tmpworkdir,
+        {
+            'grablib.yml': "download:\n  '{}': x".format(url),
+            '.grablib.lock': 'b5a3344a4b3651ebd60a1e15309d737c {} x\n'.format(url),
+            'droot': {part_name(url): 'corrupt!'},
+        },
+    )
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.side_effect = [
+        MockResponse(status_code=206, content=b' text', headers={'Content-Range': 'bytes 8-12/13'}),
+        MockResponse(),
+    ]
+    Grab(download_root='droot').download()
+    assert [c[1]['headers'] for c in mock_requests_get.call_args_list] == [{'Range': 'bytes=8-'}, {}]
+    assert gettree(tmpworkdir.join('droot')) == {'x': 'response text'}
+
+
+def test_resume_part_complete(mocker, tmpworkdir):
+    url = 'http://wherever.com/file.js'
+    mktree(
+        tmpworkdir,
+        {
+            'grablib.yml': "download:\n  '{}': x".format(url),
+            '.grablib.lock': 'b5a3344a4b3651ebd60a1e15309d737c {} x\n'.format(url),
+            'droot': {part_name(url): 'response text'},
+        },
+    )
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    Grab(download_root='droot').download()
+    assert mock_requests_get.call_count == 0
+    assert gettree(tmpworkdir.join('droot')) == {'x': 'response text'}
+
+
+def test_resume_part_not_satisfiable(mocker, tmpworkdir):
+    url = 'http://wherever.com/file.js'
+    mktree(
+        tmpworkdir,
+        {
+            'grablib.yml': "download:\n  '{}': x".format(url),
+            '.grablib.lock': 'b5a3344a4b3651ebd60a1e15309d737c {} x\n'.format(url),
+            'droot': {part_name(url): 'response text and more'},
+        },
+    )
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.side_effect = [MockResponse(status_code=416), MockResponse()]
+    Grab(download_root='droot').download()
+    assert [c[1]['headers'] for c in mock_requests_get.call_args_list] == [{'Range': 'bytes=22-'}, {}]
+    assert gettree(tmpworkdir.join('droot')) == {'x': 'response text'}
+
+
+def test_part_kept_on_error(mocker, tmpworkdir):
+    url = 'http://wherever.com/file.js'
+    mktree(
+        tmpworkdir,
+        {
+            'grablib.yml': "download:\n  '{}': x".format(url),
+            '.grablib.lock': 'b5a3344a4b3651ebd60a1e15309d737c {} x\n'.format(url),
+        },
+    )
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    response = MockResponse()
+
+    def iter_content(chunk_size):
+        yield b'response'
+        raise ChunkedEncodingError('connection reset')
+
+    mocker.patch.object(response, 'iter_content', side_effect=iter_content)
+    mock_requests_get.return_value = response
+    mocker.patch('grablib.download.time.sleep')
+    with pytest.raises(GrablibError):
+        Grab(download_root='droot').download()
+    assert gettree(tmpworkdir.join('droot')) == {part_name(url): 'response'}
+
+
+def test_retry_status(mocker, tmpworkdir):
+    mktree(tmpworkdir, {'grablib.yml': "download:\n  'http://wherever.com/file.js': x"})
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.side_effect = [
+        MockResponse(status_code=503, headers={'Retry-After': '2'}),
+        MockResponse(status_code=502),
+        MockResponse(),
+    ]
+    sleep = mocker.patch('grablib.download.time.sleep')
+    Grab(download_root='droot').download()
+    assert sleep.call_args_list == [call(2.0), call(1.0)]
+    assert gettree(tmpworkdir.join('droot')) == {'x': 'response text'}
+
+
+def test_retry_config(mocker, tmpworkdir):
+    mktree(
+        tmpworkdir,
+        {'grablib.yml': ("retry:\n  attempts: 1\n  read_timeout: null\ndownload:\n  'http://wherever.com/file.js': x")},
+    )
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.return_value = MockResponse(status_code=503)
+    sleep = mocker.patch('grablib.download.time.sleep')
+    with pytest.raises(GrablibError):
+        Grab(download_root='droot').download()
+    mock_requests_get.assert_called_once_with(
+        'http://wherever.com/file.js', stream=True, headers={}, timeout=(10, None)
+    )
+    assert sleep.called is False
+
+
+def test_retry_unknown_option(tmpworkdir):
+    with pytest.raises(GrablibError) as excinfo:
+        Downloader(download_root='droot', download={}, retry={'attempts': 2, 'foo': 1})
+    assert excinfo.value.args == ('unknown retry options: foo',)
+
+
+@pytest.mark.parametrize(
+    'retry,error',
+    [
+        ({'attempts': 0}, 'retry "attempts" must be an integer of at least 1'),
+        ({'attempts': 1.5}, 'retry "attempts" must be an integer of at least 1'),
+        ({'backoff': -1}, 'retry "backoff" must be a number of at least 0'),
+    ],
+)
+def test_retry_invalid(tmpworkdir, retry, error):
+    with pytest.raises(GrablibError) as excinfo:
+        Downloader(download_root='droot', download={}, retry=retry)
+    assert excinfo.value.args == (error,)
+
+
+def test_pool_size():
+    downloader = Downloader(download_root='droot', download={}, concurrency=8)
+    assert downloader._session.get_adapter('https://example.com')._pool_maxsize == 8
+
+
+def test_hash_algorithm(mocker, tmpworkdir):
+    mktree(tmpworkdir, {'grablib.yml': "hash_algorithm: sha256\ndownload:\n  'http://wherever.com/file.js': x"})
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.return_value = MockResponse()
+    Grab(download_root='droot').download()
+    lock = 'sha256:{} http://wherever.com/file.js x\n'.format(hashlib.sha256(b'response text').hexdigest())
+    assert tmpworkdir.join('.grablib.lock').read() == lock
+
+    Grab(download_root='droot', paranoid=True).download()
+    assert mock_requests_get.call_count == 1
+    assert tmpworkdir.join('.grablib.lock').read() == lock
+
+
+def test_hash_algorithm_old_lock(mocker, tmpworkdir):
+    mktree(
+        tmpworkdir,
+        {
+            'grablib.yml': (
+                "hash_algorithm: sha256\n"
+                "download:\n  'http://wherever.com/a.js': a.js\n  'http://wherever.com/b.js': b.js"
+            ),
+            '.grablib.lock': (
+                'b5a3344a4b3651ebd60a1e15309d737c http://wherever.com/a.js a.js\n'
+                'b5a3344a4b3651ebd60a1e15309d737c http://wherever.com/b.js b.js\n'
+            ),
+            'droot': {'a.js': 'response text', 'b.js': 'changed'},
+        },
+    )
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.return_value = MockResponse()
+    Grab(download_root='droot').download()
+    # a.js is unchanged so keeps its md5 hash, b.js is downloaded again and checked against its md5 hash
+    assert [c[0][0] for c in mock_requests_get.call_args_list] == ['http://wherever.com/b.js']
+    assert tmpworkdir.join('.grablib.lock').read() == (
+        'b5a3344a4b3651ebd60a1e15309d737c http://wherever.com/a.js a.js\n'
+        'sha256:{} http://wherever.com/b.js b.js\n'.format(hashlib.sha256(b'response text').hexdigest())
+    )
+
+    tmpworkdir.join('droot/b.js').write('changed')
+    mock_requests_get.return_value = MockResponse(content=b'evil')
+    with pytest.raises(GrablibError):
+        Grab(download_root='droot').download()
+
+
+def test_hash_algorithm_zip(mocker, tmpworkdir):
+    mktree(tmpworkdir, {'grablib.yml': 'hash_algorithm: blake2s\n' + zip_dowload_yml})
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.side_effect = request_fixture
+    Grab().download()
+    lock_lines = tmpworkdir.join('.grablib.lock').read().splitlines()
+    assert [line.split(' ')[0].split(':')[0] for line in lock_lines] == ['blake2s'] * 4
+    assert lock_lines[2] == 'blake2s:{} https://any-old-url.com/test_assets.zip subdirectory/a.txt'.format(
+        hashlib.blake2s(b'a\n').hexdigest()
+    )
+    Grab().download()
+    assert mock_requests_get.call_count == 1
+
+
+def test_hash_algorithm_cache(mocker, tmpworkdir):
+    mktree(
+        tmpworkdir,
+        {'grablib.yml': "hash_algorithm: sha1\ncache: cache\ndownload:\n  'http://wherever.com/file.js': x"},
+    )
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.return_value = MockResponse()
+    Grab(download_root='droot').download()
+    sha1 = hashlib.sha1(b'response text').hexdigest()
+    assert tmpworkdir.join('cache/downloads').listdir() == [tmpworkdir.join('cache/downloads/sha1-' + sha1)]
+
+    tmpworkdir.join('droot/x').remove()
+    Grab(download_root='droot').download()
+    assert mock_requests_get.call_count == 1
+    assert tmpworkdir.join('droot/x').read() == 'response text'
+
+
+def test_unknown_hash_algorithm(tmpworkdir):
+    with pytest.raises(GrablibError) as excinfo:
+        Downloader(download_root='droot', download={}, hash_algorithm='md4')
+    assert excinfo.value.args[0].startswith('unknown hash algorithm "md4"')
+
+
+def test_unchanged_not_journaled(mocker, tmpworkdir):
+    mktree(tmpworkdir, {'grablib.yml': "download:\n  'http://wherever.com/a.js': a.js"})
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.return_value = MockResponse()
+    Grab(download_root='droot').download()
+    lock = tmpworkdir.join('.grablib.lock').read()
+
+    fsync = mocker.spy(os, 'fsync')
+    lock_inode = os.stat(str(tmpworkdir.join('.grablib.lock'))).st_ino
+    Grab(download_root='droot').download()
+    assert fsync.call_count == 0
+    assert os.stat(str(tmpworkdir.join('.grablib.lock'))).st_ino == lock_inode
+    assert tmpworkdir.join('.grablib.lock.journal').check() is False
+
+    tmpworkdir.join('grablib.yml').write(
+        "download:\n  'http://wherever.com/a.js': a.js\n  'http://wherever.com/b.js': b.js"
+    )
+    mock_requests_get.return_value = MockResponse(status_code=404)
+    with pytest.raises(GrablibError):
+        Grab(download_root='droot').download()
+    assert tmpworkdir.join('.grablib.lock.journal').read() == ''
+    assert tmpworkdir.join('.grablib.lock').read() == lock
+
+
+@pytest.mark.parametrize(
+    'hash_,error',
+    [
+        ('xxh64:aabbccdd', 'Error importing xxhash, run `pip install xxhash` to use "xxh64"'),
+        ('crc:aabbccdd', 'unknown hash algorithm "crc", options are: '),
+    ],
+)
+def test_lock_hash_algorithm_unavailable(mocker, tmpworkdir, hash_, error):
+    mktree(
+        tmpworkdir,
+        {
+            'grablib.yml': "download:\n  'http://wherever.com/file.js': x",
+            '.grablib.lock': '{} http://wherever.com/file.js x\n'.format(hash_),
+        },
+    )
+    mocker.patch.dict('sys.modules', {'xxhash': None})
+    with pytest.raises(GrablibError) as excinfo:
+        Grab(download_root='droot').download()
+    assert excinfo.value.args[0].startswith(error)
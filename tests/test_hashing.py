@@ -0,0 +1,60 @@
+import builtins
+import hashlib
+from pathlib import Path
+
+import pytest
+
+from grablib.common import GrablibError
+from grablib.hashing import Hasher, algorithm_of, check_algorithm, data_hash, file_hash
+
+real_import = builtins.__import__
+
+
+def mocked_import(name, globals=None, locals=None, fromlist=(), level=0):
+    if name == 'xxhash':
+        raise ImportError('fake error for %s' % name)
+    return real_import(name, globals, locals, fromlist, level)
+
+
+def test_algorithm_of():
+    assert algorithm_of('acbd18db4cc2f85cedef654fccc4a4d8') == 'md5'
+    assert algorithm_of('sha256:2c26b46b68ffc68ff99b453c1d30413413422d706483bfa0f98a5e886266e7ae') == 'sha256'
+
+
+def test_data_hash():
+    assert data_hash(b'foo') == hashlib.md5(b'foo').hexdigest()
+    assert data_hash(b'foo', 'sha256') == 'sha256:' + hashlib.sha256(b'foo').hexdigest()
+    assert data_hash(b'foo', 'blake2b') == 'blake2b:' + hashlib.blake2b(b'foo').hexdigest()
+
+
+def test_file_hash(tmpdir):
+    data = bytes(range(256)) * 10_000
+    path = Path(tmpdir.join('data.bin'))
+    path.write_bytes(data)
+    assert file_hash(path) == hashlib.md5(data).hexdigest()
+    assert file_hash(path, 'sha256') == data_hash(data, 'sha256')
+
+    hasher = Hasher('sha1')
+    hasher.update(b'prefix')
+    hasher.update_file(path)
+    assert hasher.hexdigest() == 'sha1:' + hashlib.sha1(b'prefix' + data).hexdigest()
+
+
+def test_file_hash_empty(tmpdir):
+    path = Path(tmpdir.join('empty.txt'))
+    path.write_bytes(b'')
+    assert file_hash(path) == hashlib.md5(b'').hexdigest()
+
+
+def test_check_algorithm(mocker):
+    check_algorithm('sha512')
+    with pytest.raises(GrablibError) as exc_info:
+        check_algorithm('crc32')
+    assert exc_info.value.args[0] == (
+        'unknown hash algorithm "crc32", options are: '
+        'md5, sha1, sha256, sha512, blake2b, blake2s, xxh64, xxh3_64, xxh128'
+    )
+    mocker.patch('builtins.__import__', side_effect=mocked_import)
+    with pytest.raises(GrablibError) as exc_info:
+        check_algorithm('xxh64')
+    assert exc_info.value.args[0] == 'Error importing xxhash, run `pip install xxhash` to use "xxh64"'
@@ -0,0 +1,60 @@
+import re
+
+import pytest
+
+from grablib.replace import Replacer, literal_value, overlaps
+
+
+@pytest.mark.parametrize(
+    'pattern,expected',
+    [
+        ('black', 'black'),
+        (r'\.\./img/', '../img/'),
+        ('url(', None),
+        (r'\d+', None),
+        ('a.b', None),
+        ('', None),
+        ('trailing\\', None),
+    ],
+)
+def test_literal_value(pattern, expected):
+    assert literal_value(pattern) == expected
+
+
+@pytest.mark.parametrize(
+    'a,b,expected',
+    [('abc', 'xyz', False), ('abc', 'b', True), ('abc', 'cde', True), ('cde', 'abc', True), ('ab', 'ba', True)],
+)
+def test_overlaps(a, b, expected):
+    assert overlaps(a, b) is expected
+
+
+RULES = [
+    {'black': 'white', 'black;': "shouldn't change"},
+    {'../img/': '/static/img/', 'red': 'blue', 'green': 'yellow'},
+    {'red': 'green', 'green': 'blue'},
+    {'x': '', 'ab': 'AB'},
+    {'foo': 'bar', r'\d+px': 'NUM', 'baz': 'qux', 'qux': 'quux'},
+    {'aa': 'b', 'ba': 'c'},
+    {'colour': r'\g<0>s', 'red': 'blue'},
+]
+CONTENT = 'a {color: black;} b {background: url(../img/red.png); colour: green} axb 10px foo baz aaba'
+
+
+@pytest.mark.parametrize('rules', RULES)
+def test_replacer_matches_sequential(rules):
+    expected = CONTENT
+    expected_counts = []
+    for pattern, repl in rules.items():
+        expected, count = re.subn(pattern, repl, expected)
+        expected_counts.append(count)
+    assert Replacer(rules)(CONTENT) == (expected, expected_counts)
+
+
+def test_replacer_combines_literals():
+    replacer = Replacer({r'\.\./img/': '/static/img/', 'red': 'blue', 'green': 'yellow', r'\d+px': 'NUM'})
+    assert len(replacer._steps) == 2
+    assert replacer('url(../img/red.png) green 10px red') == (
+        'url(/static/img/blue.png) yellow NUM blue',
+        [1, 2, 1, 1],
+    )
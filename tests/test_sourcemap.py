@@ -0,0 +1,27 @@
+import json
+
+import pytest
+
+from grablib.sourcemap import SourceMap, vlq_encode
+
+
+@pytest.mark.parametrize(
+    'values,expected', [((0,), 'A'), ((1,), 'C'), ((-1,), 'D'), ((15,), 'e'), ((16,), 'gB'), ((123, -2, 0), '2HFA')]
+)
+def test_vlq_encode(values, expected):
+    assert vlq_encode(*values) == expected
+
+
+def test_source_map():
+    source_map = SourceMap('out.js')
+    source_map.skip_lines(1)
+    source_map.add_lines(source_map.add_source('a.js'), 3)
+    source_map.skip_lines(1)
+    source_map.add_lines(source_map.add_source('b.js'), 2, first_line=4, minified=True)
+    assert json.loads(source_map.dumps()) == {
+        'version': 3,
+        'file': 'out.js',
+        'sources': ['a.js', 'b.js'],
+        'names': [],
+        'mappings': ';AAAA;AACA;AACA;;ACEA;AAAA',
+    }
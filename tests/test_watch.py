@@ -0,0 +1,167 @@
+import sys
+import threading
+import time
+from pathlib import Path
+
+from pytest_toolbox import gettree, mktree
+
+from grablib.build import Builder
+from grablib.grab import Grab
+from grablib.watch import Watcher
+
+CONFIG = """
+download_root: downloads
+build_root: built_at
+cache: the_cache
+build:
+  cat:
+    "a.js": ["./src/a.js"]
+    "b.js": ["./src/b.js", "DL/c.js"]
+  sass:
+    css: styles
+"""
+
+
+def test_affected(tmpworkdir):
+    mktree(
+        tmpworkdir,
+        {
+            'grablib.yml': CONFIG,
+            'src': {'a.js': 'a', 'b.js': 'b'},
+            'downloads': {'c.js': 'c', '_mixin.scss': '$c: red;'},
+            'styles': {'foo.scss': 'a {color: black}'},
+        },
+    )
+    watcher = Watcher(Builder(**Grab().config_data))
+    root = Path(str(tmpworkdir))
+    assert watcher.affected({root / 'src/a.js'}) == ({'a.js'}, set())
+    assert watcher.affected({root / 'downloads/c.js', root / 'src/b.js'}) == ({'b.js'}, set())
+    assert watcher.affected({root / 'styles/foo.scss'}) == (set(), {'css'})
+    assert watcher.affected({root / 'downloads/_mixin.scss'}) == (set(), {'css'})
+    assert watcher.affected({root / 'built_at/css/foo.css', root / 'src/other.js'}) == (set(), set())
+
+
+def test_affected_paths(tmpworkdir):
+    mktree(tmpworkdir, {'grablib.yml': CONFIG, 'src': {'a.js': 'a'}})
+    watcher = Watcher(Builder(**Grab().config_data))
+    root = Path(str(tmpworkdir))
+    assert watcher.affected({root / 'src/a.js'}) == ({'a.js'}, set())
+    assert watcher.cat_data.keys() == {'a.js', 'b.js'}
+    assert watcher.sass_data == {'css': {'src': 'styles', 'incremental': True}}
+
+
+def test_rebuild(mocker, tmpworkdir):
+    mktree(
+        tmpworkdir,
+        {
+            'grablib.yml': CONFIG,
+            'src': {'a.js': 'a', 'b.js': 'b'},
+            'downloads': {'c.js': 'c'},
+            'styles': {'foo.scss': 'a {color: black}'},
+        },
+    )
+    watcher = Watcher(Builder(**Grab().config_data))
+    cat = mocker.spy(watcher.builder, 'cat')
+    sass = mocker.spy(watcher.builder, 'sass')
+    watcher.rebuild(cat_dests={'a.js'}, sass_dests=set())
+    assert cat.call_args[0][0] == {'a.js': ['./src/a.js']}
+    assert sass.call_count == 0
+    assert gettree(tmpworkdir.join('built_at')) == {'a.js': '/* === a.js === */\na\n'}
+
+
+def test_rebuild_error(tmpworkdir):
+    mktree(tmpworkdir, {'grablib.yml': CONFIG, 'styles': {'foo.scss': 'a {WRONG'}})
+    watcher = Watcher(Builder(**Grab().config_data))
+    watcher.rebuild(cat_dests=set(), sass_dests={'css'})
+    assert tmpworkdir.join('built_at/css/foo.css').check() is False
+
+
+def test_rebuild_source_deleted(tmpworkdir):
+    mktree(
+        tmpworkdir,
+        {
+            'grablib.yml': CONFIG,
+            'src': {'a.js': 'a', 'b.js': 'b'},
+            'downloads': {'c.js': 'c'},
+            'styles': {'foo.scss': 'a {color: black}'},
+        },
+    )
+    watcher = Watcher(Builder(**Grab().config_data))
+    watcher.rebuild(cat_dests={'a.js'}, sass_dests={'css'})
+    tmpworkdir.join('src/a.js').remove()
+    tmpworkdir.join('styles').remove()
+    watcher.rebuild(cat_dests={'a.js'}, sass_dests={'css'})
+
+    tmpworkdir.join('src/a.js').write('a2')
+    watcher.rebuild(cat_dests={'a.js'}, sass_dests=set())
+    assert tmpworkdir.join('built_at/a.js').read() == '/* === a.js === */\na2\n'
+
+
+def test_rebuild_debug(tmpworkdir):
+    mktree(tmpworkdir, {'grablib.yml': CONFIG + 'debug: true\n', 'styles': {'foo.scss': 'a {color: black}'}})
+    watcher = Watcher(Builder(**Grab().config_data))
+    watcher.rebuild(cat_dests=set(), sass_dests={'css'})
+    assert 'black' in tmpworkdir.join('built_at/css/foo.css').read()
+
+    tmpworkdir.join('styles/foo.scss').write('a {color: red}')
+    watcher.rebuild(cat_dests=set(), sass_dests={'css'})
+    css = tmpworkdir.join('built_at/css/foo.css').read()
+    assert 'red' in css
+    assert 'black' not in css
+    assert tmpworkdir.join('built_at/css/.src/foo.scss').read() == 'a {color: red}'
+
+
+def test_snapshot(tmpworkdir):
+    mktree(
+        tmpworkdir,
+        {
+            'grablib.yml': CONFIG,
+            'src': {'a.js': 'a'},
+            'downloads': {'c.js': 'c', 'sub': {'d.css': 'd'}},
+            'styles': {'foo.scss': 'x'},
+        },
+    )
+    watcher = Watcher(Builder(**Grab().config_data))
+    root = Path(str(tmpworkdir))
+    assert sorted(str(p.relative_to(root)) for p in watcher.snapshot()) == [
+        'downloads/c.js',
+        'downloads/sub/d.css',
+        'src/a.js',
+        'styles/foo.scss',
+    ]
+
+
+def test_run_polling(mocker, tmpworkdir):
+    mocker.patch.dict(sys.modules, {'watchdog.observers': None})
+    mktree(
+        tmpworkdir,
+        {
+            'grablib.yml': CONFIG,
+            'src': {'a.js': 'a', 'b.js': 'b'},
+            'downloads': {'c.js': 'c'},
+            'styles': {'foo.scss': 'a {color: black}'},
+        },
+    )
+    watcher = Watcher(Builder(**Grab().config_data), debounce=0.01, poll_interval=0.01)
+    rebuild = mocker.spy(watcher, 'rebuild')
+    snapshot = mocker.spy(watcher, 'snapshot')
+    thread = threading.Thread(target=watcher.run)
+    thread.start()
+    try:
+        # the second snapshot has been started so the first, taken after the initial build, is complete
+        for _ in range(500):
+            if snapshot.call_count >= 2:
+                break
+            time.sleep(0.01)
+        assert tmpworkdir.join('built_at/a.js').read() == '/* === a.js === */\na\n'
+        tmpworkdir.join('src/a.js').write('changed')
+        for _ in range(500):
+            if tmpworkdir.join('built_at/a.js').read() != '/* === a.js === */\na\n':
+                break
+            time.sleep(0.01)
+    finally:
+        watcher.stop()
+        thread.join()
+    assert rebuild.call_args_list[1][1] == {'cat_dests': {'a.js'}, 'sass_dests': set()}
+    assert tmpworkdir.join('built_at/a.js').read() == '/* === a.js === */\nchanged\n'
+    assert tmpworkdir.join('built_at/css/foo.css').read() == 'a{color:black}\n'